@@ -10,21 +10,22 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import os
+import re
+from concurrent import futures
 from datetime import datetime
 from time import sleep, time
 
 from errbot import botcmd, BotPlugin, arg_botcmd
-from googleapiclient.discovery import build
-from googleapiclient.http import MediaIoBaseUpload
 
-from charts import interval, generate_timeseries_linechart, generate_barchart
-from charts.line import Collection, Line
+import bqresults
+import gcloudutils
+from charts import interval, render
 
+# The number of rows !bq shows by default.
+DEFAULT_ROWS = 10
 
-def get_ts():
-    now = datetime.now()
-    return '%s.%d' % (now.strftime('%Y%m%d-%H%M%S'), now.microsecond)
+# !bq [--rows N] [--fresh] QUERY_OR_QUERY_INDEX
+_OPTION = re.compile(r'^\s*--(?:rows\s+(\d+)|(fresh))\s+')
 
 
 class BigQuery(BotPlugin):
@@ -34,7 +35,35 @@ class BigQuery(BotPlugin):
             self['queries'] = []
         self.gc = self.get_plugin('GoogleCloud')
         self.credentials = self.gc.credentials
-        self.bigquery = build('bigquery', 'v2', credentials=self.credentials)
+        self.bigquery = self.gc.build('bigquery', 'v2')
+        try:
+            self.read_workers = self.bot_config.BIGQUERY_READ_WORKERS
+        except AttributeError:
+            self.read_workers = bqresults.DEFAULT_READ_WORKERS
+        # Long-lived, so that its threads keep their connection to the API from one result to the next.
+        self.read_pool = futures.ThreadPoolExecutor(max_workers=self.read_workers)
+        try:
+            cache_seconds = self.bot_config.BIGQUERY_CACHE_SECONDS
+        except AttributeError:
+            cache_seconds = bqresults.DEFAULT_CACHE_SECONDS
+        try:
+            cache_entries = self.bot_config.BIGQUERY_CACHE_ENTRIES
+        except AttributeError:
+            cache_entries = bqresults.DEFAULT_CACHE_ENTRIES
+        try:
+            cache_bytes = self.bot_config.BIGQUERY_CACHE_BYTES
+        except AttributeError:
+            cache_bytes = bqresults.DEFAULT_CACHE_BYTES
+        # (project, normalized query, max results) -> (response, time it was kept at).
+        self.results = None
+        if cache_seconds:
+            self.results = gcloudutils.LRUCache(cache_entries, ttl=cache_seconds, max_bytes=cache_bytes,
+                                                sizeof=lambda cached: bqresults.response_size(cached[0]))
+
+    def deactivate(self):
+        if getattr(self, 'read_pool', None):
+            self.read_pool.shutdown(wait=False)
+        super().deactivate()
 
     def project(self):
         if not self.is_activated:
@@ -96,9 +125,33 @@ class BigQuery(BotPlugin):
     def bq_queries(self, msg, args: str):
         return '\n\n'.join("%i: %s" % (i, q) for i, q in enumerate(self['queries']))
 
+    @staticmethod
+    def format_rows(fields, rows, header=True):
+        values = '\n'.join('| ' + ' | '.join(field[1](value['v']) for field, value in zip(fields, row['f'])) + ' |'
+                           for row in rows)
+        if not header:
+            return values
+        return '| ' + ' | '.join(field[0] for field in fields) + ' |\n' + values
+
     @botcmd
     def bq(self, msg, args: str):
-        """Start a new query."""
+        """Start a new query.
+
+        Only the first 10 rows are shown, --rows N shows N rows, sent a page at a time:
+        !bq --rows 200 QUERY_OR_QUERY_INDEX
+        The results are kept for a few minutes, --fresh reruns the query anyway.
+        """
+        max_rows = DEFAULT_ROWS
+        fresh = False
+        match = _OPTION.match(args)
+        while match:
+            if match.group(2):
+                fresh = True
+            else:
+                max_rows = int(match.group(1))
+            args = args[match.end():]
+            match = _OPTION.match(args)
+
         #  if it is a number, assume it is an index for the saved queries.
         try:
             args = self['queries'][int(args)]
@@ -106,58 +159,68 @@ class BigQuery(BotPlugin):
             pass
 
         if not args:
-            return 'Usage: !bq QUERY_OR_QUERY_INDEX\nYou can save a query with !bq addquery'
+            yield 'Usage: !bq [--rows N] [--fresh] QUERY_OR_QUERY_INDEX\nYou can save a query with !bq addquery'
+            return
 
         query = args.strip()
 
-        for response, feedback in self.sync_bq_job(query):
+        for response, feedback in self.sync_bq_job(query, max_results=min(max_rows, bqresults.STREAM_PAGE_ROWS),
+                                                   fresh=fresh):
             if response:
                 break
             yield feedback
 
         fields = self.extract_fields(response['schema']['fields'])
+        pages = bqresults.iter_pages(self.bigquery.jobs(), self.project(), response, max_rows)
+        yield self.format_rows(fields, next(pages, []))
+        for rows in pages:
+            yield self.format_rows(fields, rows, header=False)
+        yield feedback
 
-        i = 0
-        rows = []
-        for row in response['rows']:
-            rows.append([field[1](value['v']) for field, value in zip(fields, row['f'])])
-            i += 1
-            if i == 10:
-                break
-        header = '| ' + ' | '.join(field[0] for field in fields) + ' |\n'
-        values = '\n'.join('| ' + ' | '.join(v for v in row) + ' |' for row in rows)
-        return header + values
-
-    def sync_bq_job(self, query: str):
+    def sync_bq_job(self, query: str, max_results: int=None, fresh: bool=False):
         """
         Execute Synchronously the given query on BigQuery.
+        A response of the same query kept by the local cache is reused unless fresh.
         :param query: the bq query
-        :return: tuple of the response or None, Feedback if None.
+        :param max_results: the number of rows of the first page, as many as fit in a page if None.
+        :param fresh: reruns the query even if its result is in the local cache.
+        :return: tuple of the response or None, Feedback if None, else the cost of the query.
         """
+        key = (self.project(), bqresults.normalize_query(query), max_results)
+        if self.results is not None and not fresh:
+            cached = self.results.get(key)
+            if cached:
+                response, kept_at = cached
+                yield response, bqresults.format_cost(response, cached_age=time() - kept_at)
+                return
+
         start_time = time()
         jobs = self.bigquery.jobs()
-        response = jobs.query(projectId=self.project(), body={'query': query}).execute()
-        job_id = None
-        while 'jobComplete' in response and not response['jobComplete']:
+        body = {'query': query}
+        if max_results is not None:
+            body['maxResults'] = max_results
+        response = jobs.query(projectId=self.project(), body=body).execute()
+        while not response.get('jobComplete', True):
             job_id = response['jobReference']['jobId']
             yield None, 'BigQuery job "%s" is in progress ... %0.2fs' % (job_id, time() - start_time)
             sleep(5)
-            response = jobs.get(projectId=self.project(), jobId=job_id).execute()
-
-        if job_id:
-            yield jobs.getQueryResults(projectId=self.project(), jobId=job_id).execute(), ''
-        else:
-            yield response, ''
+            response = jobs.getQueryResults(projectId=self.project(), jobId=job_id,
+                                            maxResults=max_results).execute()
+        if self.results is not None:
+            self.results.put(key, (response, time()))
+        yield response, bqresults.format_cost(response)
 
     @arg_botcmd('query', type=str)
     @arg_botcmd('--index', dest='index', type=str, default='0')
     @arg_botcmd('--values', dest='values', type=str)
-    def bq_chart(self, msg, query: str, index: str, values: str):
+    @arg_botcmd('--fresh', dest='fresh', action='store_true')
+    def bq_chart(self, msg, query: str, index: str, values: str, fresh: bool=False):
         """
         Start a new query and graph the result.
         By default it will autoguess the graph type depending on the first column.
         Otherwise you can specify the column index or name of the index with --index and the value columns to graph
         with --values separated with comma.
+        The results are kept for a few minutes, --fresh reruns the query anyway.
         """
         #  if it is a number, assume it is an index for the saved queries.
         try:
@@ -166,13 +229,14 @@ class BigQuery(BotPlugin):
             pass
 
         if not query:
-            yield 'Usage: !bq chart [--index nb_or_name] [--values nb_or_name,...] QUERY_OR_QUERY_INDEX\n' \
+            yield 'Usage: !bq chart [--index nb_or_name] [--values nb_or_name,...] [--fresh] QUERY_OR_QUERY_INDEX\n' \
                   'You can save a query with !bq addquery'
 
-        for response, feedback in self.sync_bq_job(query):
+        for response, feedback in self.sync_bq_job(query, max_results=bqresults.READ_PAGE_ROWS, fresh=fresh):
             if response:
                 break
             yield feedback
+        yield feedback
 
         schema_fields = response['schema']['fields']
 
@@ -190,56 +254,48 @@ class BigQuery(BotPlugin):
         else:
             values_indices = list(range(1, len(schema_fields)))  # assume all the columns are relevant
 
-        filename = '%s.%s.png' % (self.project(), get_ts())
-        output = os.path.join(self.gc.outdir, filename)
-
         if schema_fields[index_index]['type'] == 'TIMESTAMP':
             # Generate a timeseries graph.
-
-            # makes a "pivot" for the data to be graphable.
-            xs = []  # xs is constant for all the series.
-            series = [[]] * len(values_indices)
-            for row in response['rows']:
-                y = 0
-                for i, value in enumerate(row['f']):
-                    if i in values_indices:
-                        series[y].append(float(value['v']))
-                        y += 1
-                xs.append(datetime.fromtimestamp(float(row['f'][index_index]['v'])))
-
-            start, end = xs[0], xs[-1]
+            # numpy is only imported by the first chart.
+            import numpy as np
+            from charts.line import Collection, Line, to_datetime
+
+            # makes a "pivot" for the data to be graphable: one column per value, from all the pages.
+            def decode(rows):
+                xs = np.array([float(row['f'][index_index]['v']) for row in rows], dtype=np.float64)
+                ys = np.array([[float(row['f'][i]['v']) for i in values_indices] for row in rows],
+                              dtype=np.float64).reshape(len(rows), len(values_indices))
+                return xs, ys
+
+            pages = bqresults.read_pages(self.bigquery.jobs(), self.project(), response, decode,
+                                         executor=self.read_pool)
+            xs = (np.concatenate([xs for xs, _ in pages]) * 1e9).astype('datetime64[ns]')
+            series = np.concatenate([ys for _, ys in pages]).T
 
             collection = Collection(
                 lines=[Line(schema_fields[values_indices[i]]['name'], xs, ys) for i, ys in enumerate(series)],
                 title=query,
-                start=start,
-                end=end)
-
-            generate_timeseries_linechart(
-                collection=collection,
-                time_interval_display=interval.guess(start, end),
-                outfile=output,
-            )
-
-            yield self.save_image(filename, output, response)['mediaLink']
+                start=to_datetime(xs[0]),
+                end=to_datetime(xs[-1]))
+            start, end = collection.start, collection.end
+            tid = interval.guess(start, end)
+
+            digest = render.chart_digest(collection=collection, time_interval_display=tid)
+            yield self.gc.chart_link(self.bucket(), self.project(), digest,
+                                     lambda: self.gc.renderer.render_linechart(collection=collection,
+                                                                               time_interval_display=tid))
         elif schema_fields[index_index]['type'] == 'STRING':
-            labels = []
-            values = []
-            for row in response['rows']:
-                labels.append(row['f'][index_index]['v'])
-                values.append(row['f'][1]['v'])
-            with open(output, 'rb') as source:
-                generate_barchart(title=filename, ylabel='', labels=labels, values=values, outfile=source)
-            yield self.save_image(filename, output, response)['mediaLink']
+            def decode(rows):
+                return [(row['f'][index_index]['v'], row['f'][1]['v']) for row in rows]
+
+            pages = bqresults.read_pages(self.bigquery.jobs(), self.project(), response, decode,
+                                         executor=self.read_pool)
+            labels = [label for page in pages for label, _ in page]
+            values = [value for page in pages for _, value in page]
+            chart = dict(title=query, ylabel='', labels=labels, values=values)
+            digest = render.chart_digest(**chart)
+            yield self.gc.chart_link(self.bucket(), self.project(), digest,
+                                     lambda: self.gc.renderer.render_barchart(**chart))
         else:
             yield "The index column is of type %s which is not compatible for a graph: " \
                   "it should be either a TIMESTAMP or a STRING." % schema_fields[index_index]['type']
-
-    def save_image(self, filename, output, response):
-        with open(output, 'rb') as source:
-            media = MediaIoBaseUpload(source, mimetype='image/png')
-            response = self.gc.storage.objects().insert(bucket=self.bucket(),
-                                                        name=filename,
-                                                        media_body=media,
-                                                        predefinedAcl='publicRead').execute()
-        return response
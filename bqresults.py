@@ -0,0 +1,151 @@
+# Copyright 2015 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#    http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Reads the results of the BigQuery jobs page by page."""
+
+import re
+from concurrent import futures
+
+# The number of rows fetched per getQueryResults call when streaming to chat.
+STREAM_PAGE_ROWS = 50
+
+# The number of rows fetched per getQueryResults call when reading a whole result.
+READ_PAGE_ROWS = 10000
+
+# The number of pages fetched at the same time when reading whole results.
+DEFAULT_READ_WORKERS = 8
+
+# How long, how many and how much of the query responses are kept by the local result cache.
+DEFAULT_CACHE_SECONDS = 5 * 60
+DEFAULT_CACHE_ENTRIES = 100
+DEFAULT_CACHE_BYTES = 64 * 1024 * 1024
+
+# Rough in-memory footprint of one decoded cell of a response: its {'v': ...}
+# dict and its string.
+_CELL_SIZE_BYTES = 300
+
+# The string literals, quoted identifiers and comments, kept verbatim, or a run of whitespace.
+# A line comment keeps the newline that ends it.
+_VERBATIM_OR_WHITESPACE = re.compile(r"""('(?:\\.|[^'\\])*'|"(?:\\.|[^"\\])*"|`[^`]*`"""
+                                     r"""|--[^\n]*\n?|#[^\n]*\n?|/\*.*?\*/)|\s+""", re.DOTALL)
+
+
+def normalize_query(query: str) -> str:
+    """The query without its insignificant whitespace and trailing semicolon, for the cache keys.
+
+    The whitespace is only collapsed outside of the string literals and the comments.
+    """
+    collapsed = _VERBATIM_OR_WHITESPACE.sub(lambda match: match.group(1) or ' ', query)
+    return collapsed.strip().rstrip(';').rstrip()
+
+
+def response_size(response: dict) -> int:
+    """The approximate memory footprint of a query response, for the result cache."""
+    rows = response.get('rows', [])
+    return 1024 + sum(len(row['f']) for row in rows) * _CELL_SIZE_BYTES
+
+
+def format_cost(response: dict, cached_age: float=None) -> str:
+    """Reports the bytes processed by a query and where its result came from.
+
+    Args:
+      response: (dict) The jobs.query or getQueryResults response.
+      cached_age: (Optional float) Seconds since the response was kept by the
+        local cache, None if it was not served from it.
+    """
+    processed = int(response.get('totalBytesProcessed', 0))
+    unit = 'B'
+    for next_unit in ('KB', 'MB', 'GB', 'TB'):
+        if processed < 1024:
+            break
+        processed /= 1024
+        unit = next_unit
+    cost = ('%i B' % processed if unit == 'B' else '%.1f %s' % (processed, unit)) + ' processed'
+    if response.get('cacheHit'):
+        cost += ', BigQuery cache hit'
+    if cached_age is not None:
+        cost += ', from the local cache (%is old, --fresh to rerun)' % cached_age
+    return cost + '.'
+
+
+def iter_pages(jobs, project_id: str, response: dict, max_rows: int, page_rows: int=STREAM_PAGE_ROWS):
+    """Yields the rows of a query, one page at a time, up to max_rows.
+
+    Only the rows yielded are fetched: each getQueryResults call asks for the
+    next page with pageToken and caps it with maxResults.
+
+    Args:
+      jobs: (jobs resource) The BigQuery API jobs().
+      project_id: (str)
+      response: (dict) The completed jobs.query or getQueryResults response,
+        with the first page of rows.
+      max_rows: (int) The number of rows to yield in total.
+      page_rows: (Optional int) The number of rows of the next pages.
+
+    Returns:
+      (generator of list of dict) The raw rows of each page.
+    """
+    left = max_rows
+    while left > 0:
+        rows = response.get('rows', [])[:left]
+        if rows:
+            yield rows
+        left -= len(rows)
+        page_token = response.get('pageToken')
+        if left <= 0 or not page_token:
+            return
+        response = jobs.getQueryResults(projectId=project_id, jobId=response['jobReference']['jobId'],
+                                        pageToken=page_token, maxResults=min(left, page_rows)).execute()
+
+
+def read_pages(jobs, project_id: str, response: dict, decode, page_rows: int=READ_PAGE_ROWS,
+               executor: futures.Executor=None):
+    """Fetches and decodes all the pages of a query result concurrently.
+
+    The pages after the first one are known from totalRows and fetched by
+    startIndex on the executor, and each one is decoded by the thread that
+    fetched it. The jobs resource must be thread safe, see
+    gcloud.GoogleCloud.build.
+
+    Args:
+      jobs: (jobs resource) The BigQuery API jobs().
+      project_id: (str)
+      response: (dict) The completed jobs.query or getQueryResults response,
+        with the first page of rows and totalRows.
+      decode: (callable) Turns a list of raw rows into a page of values.
+      page_rows: (Optional int) The number of rows asked for per page.
+      executor: (Optional futures.Executor) Fetches the pages concurrently, best
+        a long-lived one whose threads keep their connection to the API. Without
+        it the pages are fetched one after the other on the calling thread.
+
+    Returns:
+      (list) The decoded pages, in the order of the rows.
+    """
+    first = response.get('rows', [])
+    total_rows = int(response.get('totalRows', len(first)))
+    job_id = response['jobReference']['jobId']
+
+    def fetch(start):
+        end = min(start + page_rows, total_rows)
+        rows = []
+        # A page is capped at 10 MB, so it may hold fewer rows than asked for.
+        while start + len(rows) < end:
+            page = jobs.getQueryResults(projectId=project_id, jobId=job_id, startIndex=start + len(rows),
+                                        maxResults=end - start - len(rows)).execute()
+            if not page.get('rows'):
+                break
+            rows += page['rows']
+        return decode(rows)
+
+    starts = range(len(first), total_rows, page_rows)
+    rest = executor.map(fetch, starts) if executor is not None and len(starts) > 1 else map(fetch, starts)
+    return [decode(first)] + list(rest)
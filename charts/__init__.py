@@ -10,27 +10,28 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-"""Generates a chart of Cloud Monitoring metrics. Not thread safe."""
-from matplotlib import use
-use('Agg')
+"""Generates a chart of Cloud Monitoring metrics.
 
+matplotlib and numpy are only imported by the first chart, so that the
+plugins that never draw one don't pay for them at startup.
+"""
 from numbers import Number
 from typing import List
-from charts.line import Collection
 
 import base64
+import contextlib
 import datetime
 import io
 import math
-
-
-import matplotlib.pyplot as plt
-import matplotlib.ticker as mticker
-import numpy as np
+import threading
 
 import gcloudutils
 from charts.interval import TimeIntervalDisplay
 
+# The most lines drawn in a chart, the others are folded into a band. Each line
+# adds a legend entry and the legend makes the chart taller.
+MAX_LINES = 20
+
 _FONTDICT = {
     'family': 'sans-serif',
     'color': 'lightgrey',
@@ -38,6 +39,7 @@ _FONTDICT = {
     'size': 15,
 }
 _LEGEND_LABELS_PER_ROW = 2
+_DPI = 120
 
 
 def _format_percent(value: float, unused_point=None):
@@ -100,10 +102,61 @@ def _get_x_ticks(lines, time_interval_display):
         t += tick_delta
 
 
-def generate_timeseries_linechart(collection: Collection, time_interval_display: TimeIntervalDisplay,
-                                  y_formatter=_format_number, outfile=None):
+class _FigureTemplate(threading.local):
+    """A black-on-black figure and its Agg canvas, reused between renders.
+
+    Everything is styled on the figure itself rather than through pyplot and
+    its global rcParams, and the figure is cleared after each render so that
+    nothing outlives it. There is one template per thread.
+    """
+
+    def __init__(self):
+        self._figure = None
+
+    @property
+    def figure(self):
+        if self._figure is None:
+            from matplotlib.backends.backend_agg import FigureCanvasAgg
+            from matplotlib.figure import Figure
+            self._figure = Figure(facecolor='black', edgecolor='black')
+            FigureCanvasAgg(self._figure)
+        return self._figure
+
+    @contextlib.contextmanager
+    def axes(self, width, height):
+        self.figure.set_size_inches(width, height)
+        ax = self.figure.add_subplot(1, 1, 1, facecolor='black')
+        for spine in ax.spines.values():
+            spine.set_color('white')
+        ax.tick_params(which='both', colors='white')
+        ax.xaxis.label.set_color('white')
+        ax.yaxis.label.set_color('white')
+        ax.title.set_color('white')
+        try:
+            yield ax
+        finally:
+            self.figure.clear()
+
+    def render(self, outfile):
+        """Saves the figure to outfile, or returns the PNG bytes if None."""
+        if outfile:
+            self.figure.savefig(outfile, format='png', dpi=_DPI, facecolor='black')
+            return None
+        with io.BytesIO() as out:
+            self.figure.savefig(out, format='png', dpi=_DPI, facecolor='black')
+            return out.getvalue()
+
+
+_TEMPLATE = _FigureTemplate()
+
+
+def generate_timeseries_linechart(collection, time_interval_display: TimeIntervalDisplay,
+                                  y_formatter=_format_number, outfile=None, downsample=True, max_lines=MAX_LINES,
+                                  rank_by='last'):
     """Generates a chart.
 
+    Thread safe.
+
     Args:
       collection: (line.Collection) The x-y lines to plot.
       time_interval_display: TimeIntervalDisplay.
@@ -113,82 +166,106 @@ def generate_timeseries_linechart(collection: Collection, time_interval_display:
         Defaults to the _FormatNumber function without a suffix.
         I'd recommend adding a "/h" or "/m" suffix to the formatted output if
         your time_interval_display involves a PerSeriesAligner of SUM/MEAN/COUNT.
-      outfile: (Optional file-like object | str) If None, shows a matplotlib GUI.
+      outfile: (Optional file-like object | str) If None, the PNG bytes are returned.
         If str, the name of the file to save to.
         Should have a .png extension.  Otherwise, should be sys.stdout/StringIO().
+      downsample: (Optional bool) Whether to downsample each line to the number of
+        distinct x positions of the chart, keeping its spikes. Defaults to True.
+      max_lines: (Optional int) The most lines to draw, the ones with the highest
+        last values. The others are drawn as a min/max band, see select.top_k.
+        Defaults to MAX_LINES.
+      rank_by: (Optional str) How the lines are ranked for max_lines: "last",
+        "max" or "mean". Defaults to their last value.
+
+    Returns:
+      (bytes) The PNG if no outfile was given.
     """
-    fig, ax = plt.subplots()
+    import matplotlib.dates as mdates
+    import matplotlib.ticker as mticker
+    import numpy as np
+    from matplotlib import cm
+    from charts.downsample import downsample_collection, pixel_budget
+    from charts.select import top_k
+
+    if max_lines:
+        collection = top_k(collection, max_lines, rank_by)
     num_lines = len(collection)
-    fig.set_size_inches(*_compute_graph_dimensions(num_lines))
-
-    # Make the chart black-on-black.
-    plt.style.use('dark_background')
-    ax.set_axis_bgcolor('black')
-
-    plt.locator_params(axis='y', nbins=6)
-    color_iter = plt.cm.rainbow(np.linspace(0, 1, num_lines))  # noqa
-    for current_line, color in zip(collection, color_iter):
-        actual_label = '{label}: {current_value}'.format(
-            label=current_line.label, current_value=y_formatter(current_line.ys[-1]))
-        ax.plot(current_line.xs, current_line.ys, label=actual_label, linewidth=1.8, color=color)
-
-    plt.grid(b=True, which='major', color='lightgrey', linestyle='-')
-    plt.grid(axis='x', which='minor', color='grey', linestyle='-')
-
-    ax.yaxis.set_ticks_position('left')  # Only show left y ticks.
-    ax.yaxis.set_major_formatter(mticker.FuncFormatter(y_formatter))
-    # Hide the first y label since we know it's 0.
-    ax.yaxis.get_major_ticks()[0].label1.set_visible(False)
-
-    plt.xticks(list(_get_x_ticks(collection, time_interval_display)), rotation=30)
-    ax.xaxis.set_ticks_position('bottom')  # Only show bottom x ticks.
-    ax.xaxis.set_major_formatter(time_interval_display.major_formatter)
-
-    top_of_chart_ytick_loc = ax.yaxis.get_majorticklocs()[-1]
-    ax.axhline(y=top_of_chart_ytick_loc, ls='-', color='lightgrey')
-    bottom_of_chart_ytick_loc = ax.yaxis.get_majorticklocs()[0]
-    ax.axhline(y=bottom_of_chart_ytick_loc, ls='-', color='lightgrey', linewidth=3)
-    ax.tick_params(axis='x', which='major', labelcolor='lightgrey', labelsize=10)
-    ax.tick_params(axis='y', which='major', labelcolor='lightgrey', labelsize=10)
-
-    # plt.suptitle(_generate_subtitle(lines), x=0.24, y=0.945, fontdict=_FONTDICT)
-    plt.title(collection.title, loc='left', y=1.08, x=-0.08, fontdict=_FONTDICT)
-
-    # Shrink current axis's height by 10% on the bottom and put a legend in there.
-    box = ax.get_position()
-    ax.set_position(
-        [box.x0, box.y0 + box.height * 0.1, box.width, box.height * 0.9])
-    legend = ax.legend(loc='upper center', bbox_to_anchor=(0.5, -0.05),
-                       ncol=_LEGEND_LABELS_PER_ROW, frameon=False)
-    for text in legend.get_texts():
-        plt.setp(text, color='lightgrey', fontsize=12)
-
-    if outfile:
-        fig.savefig(outfile, format='png', dpi=120)
-    else:
-        plt.show()
+    width, height = _compute_graph_dimensions(num_lines + (collection.band is not None))
+    if downsample:
+        collection = downsample_collection(collection, pixel_budget(width, _DPI))
+
+    with _TEMPLATE.axes(width, height) as ax:
+        ax.locator_params(axis='y', nbins=6)
+        color_iter = cm.rainbow(np.linspace(0, 1, num_lines))  # noqa
+        band = collection.band
+        if band is not None:
+            ax.fill_between(band.xs, band.lows, band.highs, color='grey', alpha=0.5, linewidth=0, label=band.label)
+        for current_line, color in zip(collection, color_iter):
+            actual_label = '{label}: {current_value}'.format(
+                label=current_line.label, current_value=y_formatter(current_line.ys[-1]))
+            ax.plot(current_line.xs, current_line.ys, label=actual_label, linewidth=1.8, color=color)
+
+        ax.grid(True, which='major', color='lightgrey', linestyle='-')
+        ax.grid(axis='x', which='minor', color='grey', linestyle='-')
+
+        ax.yaxis.set_ticks_position('left')  # Only show left y ticks.
+        ax.yaxis.set_major_formatter(mticker.FuncFormatter(y_formatter))
+        # Hide the first y label since we know it's 0.
+        ax.yaxis.get_major_ticks()[0].label1.set_visible(False)
+
+        ax.set_xticks(list(_get_x_ticks(collection, time_interval_display)))
+        ax.tick_params(axis='x', labelrotation=30)
+        ax.xaxis.set_ticks_position('bottom')  # Only show bottom x ticks.
+        major_formatter = time_interval_display.major_formatter
+        if isinstance(major_formatter, str):
+            major_formatter = mdates.DateFormatter(major_formatter)
+        ax.xaxis.set_major_formatter(major_formatter)
+
+        top_of_chart_ytick_loc = ax.yaxis.get_majorticklocs()[-1]
+        ax.axhline(y=top_of_chart_ytick_loc, ls='-', color='lightgrey')
+        bottom_of_chart_ytick_loc = ax.yaxis.get_majorticklocs()[0]
+        ax.axhline(y=bottom_of_chart_ytick_loc, ls='-', color='lightgrey', linewidth=3)
+        ax.tick_params(axis='x', which='major', labelcolor='lightgrey', labelsize=10)
+        ax.tick_params(axis='y', which='major', labelcolor='lightgrey', labelsize=10)
+
+        # ax.figure.suptitle(_generate_subtitle(lines), x=0.24, y=0.945, fontdict=_FONTDICT)
+        ax.set_title(collection.title, loc='left', y=1.08, x=-0.08, fontdict=_FONTDICT)
+
+        # Shrink current axis's height by 10% on the bottom and put a legend in there.
+        box = ax.get_position()
+        ax.set_position(
+            [box.x0, box.y0 + box.height * 0.1, box.width, box.height * 0.9])
+        legend = ax.legend(loc='upper center', bbox_to_anchor=(0.5, -0.05),
+                           ncol=_LEGEND_LABELS_PER_ROW, frameon=False)
+        for text in legend.get_texts():
+            text.set_color('lightgrey')
+            text.set_fontsize(12)
+
+        return _TEMPLATE.render(outfile)
 
 
 def generate_barchart(title: str, ylabel: str, labels: List[str], values: List[Number], outfile=None):
+    """Generates a bar chart. Thread safe.
+
+    Returns:
+      (bytes) The PNG if no outfile was given.
+    """
+    import numpy as np
+
     ind = np.arange(len(values))
     width = 1
-    fig, ax = plt.subplots()
-    ax.bar(ind, values, width, color='r')
-    ax.set_xticks(ind + width / 2)
-    ax.set_xticklabels(labels, rotation=45)
-    plt.ylabel(ylabel)
-    plt.title(title)
-    plt.grid(True)
-    if outfile:
-        fig.savefig(outfile, format='png', dpi=120)
-    else:
-        plt.show()
+    with _TEMPLATE.axes(*_compute_graph_dimensions(0)) as ax:
+        ax.bar(ind, values, width, color='r')
+        ax.set_xticks(ind + width / 2)
+        ax.set_xticklabels(labels, rotation=45)
+        ax.set_ylabel(ylabel)
+        ax.set_title(title)
+        ax.grid(True)
+        return _TEMPLATE.render(outfile)
 
 
 def stringify(**kwargs):
     """Returns a base64-encoded chart for the given kwargs."""
     if 'outfile' in kwargs:
         raise ValueError('must not set chart outfile', kwargs)
-    with io.BytesIO() as out:
-        generate_timeseries_linechart(outfile=out, **kwargs)
-        return base64.encodebytes(out.getvalue()).decode()
+    return base64.encodebytes(generate_timeseries_linechart(**kwargs)).decode()
@@ -0,0 +1,221 @@
+# Copyright 2015 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#    http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Caches timeseries points in memory and refreshes only their tail."""
+
+from collections import OrderedDict
+from datetime import datetime, timedelta
+import threading
+import time
+
+from charts import timeseries
+
+# Rough in-memory footprint of one cached point: its datetime64 and float64
+# columns, and of the labels of one cached series.
+_POINT_SIZE_BYTES = 16
+_SERIES_SIZE_BYTES = 1024
+
+# How late the unaligned points may be written: the tail of their entries is
+# refetched from this long before the newest cached point.
+LATE_POINTS_ALLOWANCE = timedelta(minutes=2)
+
+
+class _Entry(object):
+    def __init__(self, start: datetime, end: datetime):
+        """The decoded points of the series of one request, see CachingClient.
+
+        The arrays are never modified in place, so that copies of an entry
+        can share them.
+        """
+        self.start, self.end = start, end
+        self.fetched_at = time.monotonic()
+        # The endTime of the newest cached point, None if there is none.
+        self.newest = None
+        # series key -> (series without points, xs datetime64[ns] array, ys float64 array)
+        self.series = {}
+
+    def merge(self, api_serieses):
+        """Decodes the points of the series in, they replace the cached points with the same endTime."""
+        from charts import line  # numpy is only imported by the first chart.
+        import numpy as np
+
+        for api_series in api_serieses:
+            key = timeseries._series_key(api_series)
+            xs, ys = line.decode_columns(api_series.get('points', []))
+            if key in self.series:
+                header, old_xs, old_ys = self.series[key]
+                # np.unique keeps the first of the duplicated endTimes, the new point.
+                xs, first = np.unique(np.concatenate([xs, old_xs]), return_index=True)
+                ys = np.concatenate([ys, old_ys])[first]
+            else:
+                header = {k: v for k, v in api_series.items() if k != 'points'}
+            self.series[key] = (header, xs, ys)
+            if len(xs):
+                newest = xs[-1].astype('datetime64[us]').item()
+                if self.newest is None or newest > self.newest:
+                    self.newest = newest
+
+    def trim(self, start: datetime):
+        """Drops the points that end before start."""
+        import numpy as np
+
+        for key, (header, xs, ys) in self.series.items():
+            kept = xs >= np.datetime64(start, 'ns')
+            self.series[key] = (header, xs[kept], ys[kept])
+        self.start = start
+
+    def select(self, start: datetime, end: datetime):
+        """Returns the cached series that have points in [start, end], with
+        their decoded points as columns=(xs, ys) instead of points."""
+        from charts import line
+
+        out = []
+        for header, xs, ys in self.series.values():
+            columns = line._in_window(xs, ys, start, end)
+            if len(columns[0]):
+                out.append(dict(header, columns=columns))
+        return out
+
+    def size(self):
+        return sum(_SERIES_SIZE_BYTES + len(xs) * _POINT_SIZE_BYTES for _, xs, _ in self.series.values())
+
+
+class TimeseriesCache(object):
+    def __init__(self, ttl: float=300, max_bytes: int=64 * 1024 * 1024):
+        """An LRU of aligned timeseries points.
+
+        Entries are keyed by (project, metric, aligner, alignment period), the
+        partial response fields, the cross series reduction and the filter.
+        Thread safe.
+
+        Args:
+          ttl: (Optional float) Seconds after which an entry is fully refetched,
+            in case older points have been revised by the API. Defaults to 5 minutes.
+          max_bytes: (Optional int) The approximate memory budget of the cache.
+            The least recently used entries are evicted past it. Defaults to 64MB.
+        """
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._sizes = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if time.monotonic() - entry.fetched_at > self.ttl:
+                self._remove(key)
+                return None
+            self._entries.move_to_end(key)
+            return entry
+
+    def put(self, key, entry: _Entry):
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = entry
+            self._sizes[key] = entry.size()
+            while sum(self._sizes.values()) > self.max_bytes and len(self._entries) > 1:
+                self._remove(next(iter(self._entries)))
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._sizes.clear()
+
+    def _remove(self, key):
+        del self._entries[key]
+        del self._sizes[key]
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class CachingClient(object):
+    def __init__(self, client: timeseries.Client, cache: TimeseriesCache):
+        """Serves timeseries.Client.list_timeseries from a TimeseriesCache.
+
+        Only the tail of the interval is fetched, from the newest cached point:
+        its bucket may have been incomplete, and the unaligned points may be
+        written late, see LATE_POINTS_ALLOWANCE.
+        """
+        self._client = client
+        self._cache = cache
+
+    def list_timeseries(self,
+                        project_id: str,
+                        metric: str,
+                        start_time: datetime,
+                        end_time: datetime,
+                        alignment_period: str=timeseries.AlignmentPeriods.MINUTES_1.value,
+                        per_series_aligner: str=timeseries.PerSeriesAligners.MAX.value,
+                        **kwargs):
+        """Same as timeseries.Client.list_timeseries, but the series have their
+        decoded points as columns=(xs, ys) instead of points, see line._get_lines.
+
+        The aligned requests end on a whole alignment period, so that the
+        buckets of the successive tails line up with the cached ones.
+        """
+        aligned = per_series_aligner and per_series_aligner != timeseries.PerSeriesAligners.NONE.value
+        if aligned:
+            period = timeseries._alignment_period_string_to_delta(alignment_period)
+            end_time -= (end_time - datetime.min) % period
+
+        key = (project_id, metric, per_series_aligner, alignment_period,
+               kwargs.get('fields', timeseries.TIMESERIES_FIELDS),
+               kwargs.get('cross_series_reducer'), tuple(kwargs.get('group_by_fields') or ()),
+               kwargs.get('filter'))
+        lookup_start = start_time - period if aligned else start_time
+
+        def _fetch(start, end, **overrides):
+            return self._client.list_timeseries(
+                project_id=project_id, metric=metric, start_time=start, end_time=end,
+                alignment_period=alignment_period, per_series_aligner=per_series_aligner,
+                **dict(kwargs, **overrides))
+
+        entry = self._cache.get(key)
+        if entry is None or start_time < entry.start:
+            entry = _Entry(start_time, end_time)
+            entry.merge(_fetch(start_time, end_time))
+        elif end_time > entry.end:
+            if entry.newest is None:
+                tail_start = entry.start
+            elif aligned:
+                # list_timeseries starts yet another alignment period earlier.
+                tail_start = entry.newest - period
+            else:
+                tail_start = entry.newest - LATE_POINTS_ALLOWANCE
+            # The tail is short, a single request.
+            tail = _fetch(max(tail_start, entry.start), end_time, max_workers=None)
+            entry = self._extend(entry, tail, lookup_start, end_time)
+        self._cache.put(key, entry)
+
+        return entry.select(lookup_start, end_time)
+
+    def iter_timeseries(self, *args, **kwargs):
+        """Same as timeseries.Client.iter_timeseries, but nothing is streamed: the
+        series are all held by the cache anyway."""
+        return iter(self.list_timeseries(*args, **kwargs))
+
+    @staticmethod
+    def _extend(entry: _Entry, tail, oldest: datetime, end_time: datetime):
+        """Returns a copy of entry with the tail merged in and the points older
+        than oldest dropped, so that readers never see a half updated entry."""
+        extended = _Entry(entry.start, end_time)
+        extended.fetched_at = entry.fetched_at
+        extended.newest = entry.newest
+        extended.series = dict(entry.series)
+        extended.merge(tail)
+        extended.trim(max(entry.start, oldest))
+        return extended
@@ -0,0 +1,175 @@
+# Copyright 2015 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#    http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""An in-memory, searchable index of the metric descriptors of a project."""
+
+import bisect
+import re
+import time
+
+# The only fields of a metricDescriptors list response read by the plugins.
+DESCRIPTOR_FIELDS = 'nextPageToken,metricDescriptors(type,description)'
+
+_TOKEN_SEPARATORS = re.compile(r'[/._\-\s]+')
+
+
+def _tokenize(string):
+    return {token for token in _TOKEN_SEPARATORS.split(string.lower()) if token}
+
+
+class _Snapshot(object):
+    """The immutable content of an index, swapped in one piece on refresh."""
+
+    def __init__(self, descriptors):
+        self.by_type = {d['type']: d for d in descriptors}
+        self.types = sorted(self.by_type)
+        self.lowered = [(t.lower(), self.by_type[t].get('description', '').lower()) for t in self.types]
+        self.tokens = {}
+        for metric_type, descriptor in self.by_type.items():
+            for token in _tokenize(metric_type) | _tokenize(descriptor.get('description', '')):
+                self.tokens.setdefault(token, set()).add(metric_type)
+
+
+class DescriptorIndex(object):
+    def __init__(self, monitoring_api_client, project_id: str, fields: str=DESCRIPTOR_FIELDS):
+        """Indexes every metric descriptor of a project.
+
+        Call load() once, then refresh() periodically (e.g. from a poller).
+        Lookups and searches never hit the API, except get() for a metric type
+        that was created after the last refresh.
+
+        Args:
+          monitoring_api_client: (Monitoring API client)
+          project_id: (str) The project ID from Cloud Platform.
+          fields: (Optional str) The partial response selector. Defaults to the
+            type and description of each descriptor. None indexes the full descriptors.
+        """
+        self._monitoring_api_client = monitoring_api_client
+        self.project_id = project_id
+        self.fields = fields
+        self._snapshot = None
+        self.loaded_at = None
+
+    def _list(self, filter=None):
+        out = []
+
+        default_request_kwargs = dict(
+            name='projects/{}'.format(self.project_id),
+        )
+        if filter:
+            default_request_kwargs['filter'] = filter
+        if self.fields:
+            default_request_kwargs['fields'] = self.fields
+
+        def _do_request(next_page_token=None):
+            kwargs = default_request_kwargs.copy()
+            if next_page_token:
+                kwargs['pageToken'] = next_page_token
+            req = self._monitoring_api_client.projects().metricDescriptors().list(**kwargs)
+            return req.execute()
+
+        response = _do_request()
+        out.extend(response.get('metricDescriptors', []))
+
+        next_token = response.get('nextPageToken')
+        while next_token:
+            response = _do_request(next_token)
+            out.extend(response.get('metricDescriptors', []))
+            next_token = response.get('nextPageToken')
+
+        return out
+
+    @property
+    def loaded(self):
+        return self._snapshot is not None
+
+    def load(self):
+        """Fetches every descriptor of the project and replaces the index."""
+        self._snapshot = _Snapshot(self._list())
+        self.loaded_at = time.time()
+
+    refresh = load
+
+    def _ensure_loaded(self):
+        if not self.loaded:
+            self.load()
+        return self._snapshot
+
+    def __len__(self):
+        return len(self._ensure_loaded().types)
+
+    def get(self, metric_type: str):
+        """Returns the descriptor of the given metric type or None."""
+        snapshot = self._ensure_loaded()
+        descriptor = snapshot.by_type.get(metric_type)
+        if descriptor is None:
+            # Maybe a metric created since the last refresh.
+            found = self._list('metric.type = "%s"' % metric_type)
+            if found:
+                descriptor = found[0]
+                self._snapshot = _Snapshot(list(snapshot.by_type.values()) + [descriptor])
+        return descriptor
+
+    def get_many(self, metric_types):
+        """Returns the descriptors of the given metric types, in order, or None for the unknown ones.
+
+        The metric types created since the last refresh are fetched in a
+        single call.
+        """
+        snapshot = self._ensure_loaded()
+        missing = sorted({t for t in metric_types if t not in snapshot.by_type})
+        if missing:
+            found = self._list(' OR '.join('metric.type = "%s"' % metric_type for metric_type in missing))
+            if found:
+                snapshot = self._snapshot = _Snapshot(list(snapshot.by_type.values()) + found)
+        return [snapshot.by_type.get(metric_type) for metric_type in metric_types]
+
+    def find_by_prefix(self, prefix: str):
+        snapshot = self._ensure_loaded()
+        start = bisect.bisect_left(snapshot.types, prefix)
+        end = bisect.bisect_left(snapshot.types, prefix + '\uffff')
+        return [snapshot.by_type[t] for t in snapshot.types[start:end]]
+
+    def find_by_substring(self, substring: str):
+        snapshot = self._ensure_loaded()
+        substring = substring.lower()
+        return [snapshot.by_type[metric_type]
+                for metric_type, (lowered_type, lowered_description) in zip(snapshot.types, snapshot.lowered)
+                if substring in lowered_type or substring in lowered_description]
+
+    def find_by_tokens(self, query: str):
+        """Returns the descriptors having every token of the query."""
+        snapshot = self._ensure_loaded()
+        tokens = _tokenize(query)
+        if not tokens:
+            return []
+        matches = set.intersection(*(snapshot.tokens.get(token, set()) for token in tokens))
+        return [snapshot.by_type[t] for t in sorted(matches)]
+
+    def search(self, query: str=None):
+        """Searches the descriptors by prefix, then substring, then tokens.
+
+        Returns every descriptor if no query is given.
+        """
+        snapshot = self._ensure_loaded()
+        if not query:
+            return [snapshot.by_type[t] for t in snapshot.types]
+
+        out, seen = [], set()
+        for descriptors in (self.find_by_prefix(query),
+                            self.find_by_substring(query),
+                            self.find_by_tokens(query)):
+            for descriptor in descriptors:
+                if descriptor['type'] not in seen:
+                    seen.add(descriptor['type'])
+                    out.append(descriptor)
+        return out
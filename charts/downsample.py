@@ -0,0 +1,88 @@
+# Copyright 2015 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#    http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Downsamples lines to what a chart can actually display."""
+
+import numpy as np
+
+from charts.line import Band, Collection, Line
+
+
+def pixel_budget(width_inches: float, dpi: int) -> int:
+    """The number of distinct x positions a chart of the given width can show."""
+    return int(width_inches * dpi)
+
+
+def lttb(xs: np.ndarray, ys: np.ndarray, threshold: int):
+    """Downsamples a line with the Largest-Triangle-Three-Buckets algorithm.
+
+    The first and last points are always kept. The other points are split into
+    threshold - 2 buckets, and from each bucket the point forming the largest
+    triangle with the previously kept point and the average of the next bucket
+    is kept, which preserves the spikes.
+    See Sveinn Steinarsson, "Downsampling Time Series for Visual Representation".
+
+    Args:
+      xs: (np.ndarray) The sorted x values, numbers or datetime64.
+      ys: (np.ndarray) The y values.
+      threshold: (int) The number of points to keep.
+
+    Returns:
+      (xs, ys) with at most threshold points.
+    """
+    n = len(xs)
+    if threshold >= n or threshold < 3:
+        return xs, ys
+
+    x = xs.astype(np.int64) if np.issubdtype(xs.dtype, np.datetime64) else xs
+    x = x.astype(np.float64)
+    y = ys.astype(np.float64)
+
+    every = (n - 2) / (threshold - 2)
+    kept = np.empty(threshold, dtype=np.int64)
+    kept[0], kept[-1] = 0, n - 1
+
+    a = 0
+    for i in range(threshold - 2):
+        start = int(i * every) + 1
+        end = int((i + 1) * every) + 1
+        next_end = min(int((i + 2) * every) + 1, n)
+        avg_x = x[end:next_end].mean()
+        avg_y = y[end:next_end].mean()
+
+        areas = np.abs((x[a] - avg_x) * (y[start:end] - y[a]) -
+                       (x[a] - x[start:end]) * (avg_y - y[a]))
+        a = start + int(np.argmax(areas))
+        kept[i + 1] = a
+
+    return xs[kept], ys[kept]
+
+
+def downsample_band(band: Band, max_points: int) -> Band:
+    """Downsamples an envelope to max_points buckets, keeping the min and max of each."""
+    n = len(band.xs)
+    if n <= max_points:
+        return band
+    starts = (np.arange(max_points) * n) // max_points
+    return Band(band.label, band.xs[starts],
+                np.minimum.reduceat(band.lows, starts), np.maximum.reduceat(band.highs, starts), band.count)
+
+
+def downsample_collection(collection: Collection, max_points: int) -> Collection:
+    """Returns a collection whose lines and band have at most max_points points each."""
+    band = collection.band
+    if all(len(line.xs) <= max_points for line in collection) and (band is None or len(band.xs) <= max_points):
+        return collection
+    lines = [Line(line.label, *lttb(line.xs, line.ys, max_points)) for line in collection]
+    if band is not None:
+        band = downsample_band(band, max_points)
+    return Collection(lines=lines, title=collection.title, start=collection.start, end=collection.end, band=band)
@@ -14,18 +14,18 @@
 
 import datetime
 
-import matplotlib.dates as mdates
-
 from charts import timeseries
 
-HOURS_FORMATTER = mdates.DateFormatter('%H:%M')
-DAYS_FORMATTER = mdates.DateFormatter('%x')
+# strftime formats of the x-axis labels, turned into matplotlib formatters when
+# a chart is drawn.
+HOURS_FORMATTER = '%H:%M'
+DAYS_FORMATTER = '%x'
 
 
 class TimeIntervalDisplay(object):
     def __init__(self, tick_minutes, alignment_period=None,
                  per_series_aligner=None,
-                 major_formatter=mdates.DateFormatter('%H:%M')):
+                 major_formatter=HOURS_FORMATTER):
         """Visual configuration for the time interval to display in a graph.
 
         Args:
@@ -35,9 +35,9 @@ class TimeIntervalDisplay(object):
             to a moment in time rather than a bucket of time. Min is 60s.
           per_series_aligner: (Optional str) E.g., "ALIGN_MAX".  The aligner to use
             for each series.
-          major_formatter: (Optional matplotlib.Formatter) The formatter for each
-            major tick mark's x-axis time label. Defaults to one that turns an X point
-            into HH:MM e.g., "17:35".
+          major_formatter: (Optional str | matplotlib.Formatter) The strftime format
+            or the formatter for each major tick mark's x-axis time label. Defaults
+            to one that turns an X point into HH:MM e.g., "17:35".
         """
         self.tick_minutes = tick_minutes
         self.alignment_period = alignment_period
@@ -12,18 +12,33 @@
 
 """Gets lines from the timeseries API."""
 
+from concurrent import futures
+import copy
 from datetime import datetime
 from typing import Sequence, Any
 
+import numpy as np
+
+
+def to_datetime(dt64: np.datetime64) -> datetime:
+    """Converts a numpy datetime64 to a timezone-naive datetime."""
+    return dt64.astype('datetime64[us]').item()
+
 
 class Line(object):
+    __slots__ = ('label', 'xs', 'ys')
+
     def __init__(self, label, xs: Sequence[Any], ys: Sequence[float]):
-        """A labeled series of X and Y points."""
+        """A labeled series of X and Y points.
+
+        The points are stored as columns: xs as a datetime64[ns] array and
+        ys as a float64 array.
+        """
         if len(xs) != len(ys):
             raise ValueError('must have equal number of xs and ys', xs, ys, label)
         self.label = label
-        self.xs = xs
-        self.ys = ys
+        self.xs = np.asarray(xs, dtype='datetime64[ns]')
+        self.ys = np.asarray(ys, dtype=np.float64)
 
     def __str__(self):
         return '<Line label="{label}">\nX:{xs}\nY:{ys}\n</Line>'.format(
@@ -32,16 +47,63 @@ class Line(object):
     __repr__ = __str__
 
 
+class Band(object):
+    __slots__ = ('label', 'xs', 'lows', 'highs', 'count')
+
+    def __init__(self, label, xs: Sequence[Any], lows: Sequence[float], highs: Sequence[float], count: int=0):
+        """A labeled min/max envelope, e.g. of the lines left out of a chart.
+
+        Stored as columns like a Line: xs as a datetime64[ns] array, lows and
+        highs as float64 arrays. count is the number of lines it envelops.
+        """
+        if not len(xs) == len(lows) == len(highs):
+            raise ValueError('must have equal number of xs, lows and highs', label)
+        self.label = label
+        self.xs = np.asarray(xs, dtype='datetime64[ns]')
+        self.lows = np.asarray(lows, dtype=np.float64)
+        self.highs = np.asarray(highs, dtype=np.float64)
+        self.count = count
+
+    def __str__(self):
+        return '<Band label="{label}">\nX:{xs}\nLow:{lows}\nHigh:{highs}\n</Band>'.format(
+            label=self.label, xs=self.xs, lows=self.lows, highs=self.highs)
+
+    __repr__ = __str__
+
+
 class Collection(object):
     """
     This is a collection of timeseries lines.
+
+    It may also have a band, drawn behind the lines.
     """
-    def __init__(self, lines: Sequence[Line], title: str, start: datetime, end: datetime):
+    def __init__(self, lines: Sequence[Line], title: str, start: datetime, end: datetime, band: Band=None):
         self._lines = lines
         self.title = title
         self.start, self.end = start, end
-        self.min = min(line.xs[0] for line in lines)
-        self.max = max(line.xs[-1] for line in lines)
+        self.band = band
+        non_empty = [line for line in lines if len(line.xs)]
+        if band is not None and len(band.xs):
+            non_empty.append(band)
+        self.min = to_datetime(min(line.xs[0] for line in non_empty))
+        self.max = to_datetime(max(line.xs[-1] for line in non_empty))
+        self._aligned = None
+
+    def aligned(self):
+        """Gets the lines as one 2-D matrix if they all share the same xs.
+
+        Returns:
+          (xs, ys) where xs is the shared datetime64[ns] array and ys a
+          float64 array of shape (number of lines, number of xs), or None if
+          the lines don't share their xs.
+        """
+        if self._aligned is None:
+            xs = self._lines[0].xs if self._lines else None
+            if xs is not None and all(np.array_equal(line.xs, xs) for line in self._lines):
+                self._aligned = xs, np.vstack([line.ys for line in self._lines])
+            else:
+                self._aligned = False
+        return self._aligned or None
 
     def __iter__(self):
         return iter(self._lines)
@@ -90,6 +152,56 @@ def _value_of_point(point):
     raise ValueError('point must have int or double value', point)
 
 
+def _values_of_points(points):
+    """Extracts the numeric values of points in bulk, see _value_of_point."""
+    values = [pt['value'] for pt in points]
+    try:
+        if values and 'int64Value' in values[0]:
+            return np.array([v['int64Value'] for v in values], dtype=np.int64).astype(np.float64)
+        return np.array([v['doubleValue'] for v in values], dtype=np.float64)
+    except KeyError:
+        # Mixed value types: the point by point decoder raises for bad points.
+        return np.array([_value_of_point(pt) for pt in points], dtype=np.float64)
+
+
+def _decode_points(points, start: datetime, end: datetime):
+    """Decodes the points of a series in one pass.
+
+    The RFC3339 endTimes are parsed in one batch (see _datetime_of_point), the
+    points are sorted only if they aren't in order already, and the ones outside
+    of [start, end] are masked out.
+
+    Returns:
+      (xs, ys) as a datetime64[ns] array and a float64 array.
+    """
+    xs, ys = decode_columns(points)
+    return _in_window(xs, ys, start, end)
+
+
+def decode_columns(points):
+    """Decodes all the points of a series, sorted by their endTime, see _decode_points."""
+    # Strips the "Z": numpy only parses timezone-naive strings.
+    xs = np.array([pt['interval']['endTime'][:-1] for pt in points], dtype='datetime64[ns]')
+    ys = _values_of_points(points)
+
+    if len(xs) > 1:
+        deltas = np.diff(xs)
+        if (deltas <= np.timedelta64(0)).all():
+            # The API returns the newest points first.
+            xs, ys = xs[::-1], ys[::-1]
+        elif not (deltas >= np.timedelta64(0)).all():
+            order = np.argsort(xs, kind='stable')
+            xs, ys = xs[order], ys[order]
+    return xs, ys
+
+
+def _in_window(xs, ys, start: datetime, end: datetime):
+    in_window = (xs >= np.datetime64(start, 'ns')) & (xs <= np.datetime64(end, 'ns'))
+    if not in_window.all():
+        xs, ys = xs[in_window], ys[in_window]
+    return xs, ys
+
+
 def _get_series_label_gce(api_series):
     return api_series['metric']['labels']['instance_name']
 
@@ -114,7 +226,16 @@ def _get_series_label_gae(api_series):
         raise ValueError('need new GAE label template', api_series)
 
 
-def get_collection_from_metrics(api, project_id, metric, start, end, time_interval_display):
+def _get_series_label_reduced(api_series):
+    """Labels a reduced series after the values of its group by fields."""
+    metric_labels = api_series.get('metric', {}).get('labels', {})
+    resource_labels = api_series.get('resource', {}).get('labels', {})
+    values = [labels[name] for labels in (resource_labels, metric_labels) for name in sorted(labels)]
+    return ' - '.join(values) or 'all'
+
+
+def get_collection_from_metrics(api, project_id, metric, start, end, time_interval_display, max_workers=None,
+                                cross_series_reducer=None, group_by_fields=None):
     """Gets a collection of lines for a given project and metric.
 
     Args:
@@ -127,33 +248,178 @@ def get_collection_from_metrics(api, project_id, metric, start, end, time_interv
       end: (datetime) A timezone-naive datetime object.
         Represents the datetime, in UTC, of the final moment to look at.
       time_interval_display: (interval.TimeIntervalDisplay)
+      max_workers: (Optional int) The number of time shards to fetch concurrently.
+        See timeseries.Client.list_timeseries.
+      cross_series_reducer: (Optional str) E.g., "REDUCE_MEAN". Reduces the series
+        server side, see timeseries.Client.list_timeseries.
+      group_by_fields: (Optional list of str) E.g., ["resource.label.zone"]. One
+        line is drawn per group.
     """
-    api_serieses = api.list_timeseries(
+    lines = _get_lines(api, project_id, metric, start, end, time_interval_display, max_workers,
+                       cross_series_reducer, group_by_fields)
+    if not lines:
+        raise ValueError('no series found', project_id, metric, start, end)
+
+    return Collection(lines=lines, title=metric, start=start, end=end)
+
+
+def _get_lines(api, project_id, metric, start, end, time_interval_display, max_workers,
+               cross_series_reducer=None, group_by_fields=None, filter=None):
+    api_serieses = api.iter_timeseries(
         project_id=project_id, metric=metric, start_time=start, end_time=end,
         per_series_aligner=time_interval_display.per_series_aligner,
         alignment_period=time_interval_display.alignment_period,
+        max_workers=max_workers,
+        cross_series_reducer=cross_series_reducer,
+        group_by_fields=group_by_fields,
+        filter=filter,
     )
-    if not api_serieses:
-        raise ValueError('no series found', project_id, metric, start, end)
 
-    if metric.startswith('compute.'):
+    if cross_series_reducer:
+        get_label = _get_series_label_reduced
+    elif metric.startswith('compute.'):
         get_label = _get_series_label_gce
     else:
         get_label = _get_series_label_gae
 
+    # From a plain timeseries.Client, each raw series is decoded and dropped
+    # before the next one is pulled. A CachingClient serves them decoded already.
     lines = []
     for api_series in api_serieses:
-        points = api_series['points']
-        points.sort(key=_datetime_of_point)
+        if 'columns' in api_series:
+            xs, ys = _in_window(*api_series['columns'], start=start, end=end)
+        else:
+            xs, ys = _decode_points(api_series['points'], start, end)
+        lines.append(Line(xs=xs, ys=ys, label=get_label(api_series)))
+    return lines
 
-        xs, ys = [], []
-        for pt in points:
-            dt = _datetime_of_point(pt)
-            if dt < start or dt > end:
-                continue
-            xs.append(dt)
-            ys.append(_value_of_point(pt))
 
-        lines.append(Line(xs=xs, ys=ys, label=get_label(api_series)))
+def _short_metric_name(metric: str):
+    """E.g., "cpu/utilization" for "compute.googleapis.com/instance/cpu/utilization"."""
+    return '/'.join(metric.split('/')[-2:])
 
-    return Collection(lines=lines, title=metric, start=start, end=end)
+
+def merge_collections(collections: Sequence[Collection], title: str=None) -> Collection:
+    """Merges collections of different metrics into one, to chart them together.
+
+    The labels of the lines are prefixed with the short name of their metric,
+    taken from the collection titles, when there is more than one collection.
+    """
+    if len(collections) == 1:
+        return collections[0]
+    lines = [Line('%s %s' % (_short_metric_name(collection.title), line.label), line.xs, line.ys)
+             for collection in collections for line in collection]
+    return Collection(lines=lines,
+                      title=title or ', '.join(_short_metric_name(c.title) for c in collections),
+                      start=min(c.start for c in collections),
+                      end=max(c.end for c in collections))
+
+
+def _map(fn, items, executor: futures.Executor=None):
+    """Maps fn over items on the executor, or on the calling thread for a single item.
+
+    The calling thread keeps its connection to the API, see gcloudhttp.Transport,
+    and so do the long-lived threads of the executor.
+    """
+    if executor is None or len(items) < 2:
+        return [fn(item) for item in items]
+    return list(executor.map(fn, items))
+
+
+def get_collection_from_many_metrics(api, project_id, metrics, start, end, time_interval_display,
+                                     max_workers=None, cross_series_reducer=None, group_by_fields=None,
+                                     executor=None):
+    """Gets one collection of the lines of several metrics, fetched concurrently.
+
+    Args:
+      metrics: (list of str) The metric names.
+      executor: (Optional futures.Executor) Fetches the metrics concurrently.
+        Without it they are fetched one after the other on the calling thread.
+      The other arguments are the ones of get_collection_from_metrics.
+
+    Raises:
+      ValueError: if none of the metrics has any series.
+    """
+    lines_per_metric = _map(
+        lambda metric: _get_lines(api, project_id, metric, start, end, time_interval_display, max_workers,
+                                  cross_series_reducer, group_by_fields),
+        metrics, executor)
+    # The metrics without any series in the interval are left out.
+    collections = [Collection(lines=lines, title=metric, start=start, end=end)
+                   for metric, lines in zip(metrics, lines_per_metric) if lines]
+
+    if not collections:
+        raise ValueError('no series found', project_id, metrics, start, end)
+    return merge_collections(collections)
+
+
+class DataSet(object):
+    __slots__ = ('label', 'metric', 'filter', 'per_series_aligner', 'alignment_period',
+                 'cross_series_reducer', 'group_by_fields')
+
+    def __init__(self, label: str, metric: str, filter: str, per_series_aligner: str=None,
+                 alignment_period: str=None, cross_series_reducer: str=None, group_by_fields: Sequence[str]=None):
+        """The series of a metric selected by a filter, e.g. a dataSet of a dashboard chart.
+
+        The aggregation, if any, replaces the one of the chart's time interval.
+        See timeseries.Client.list_timeseries for the arguments.
+        """
+        self.label = label
+        self.metric = metric
+        self.filter = filter
+        self.per_series_aligner = per_series_aligner
+        self.alignment_period = alignment_period
+        self.cross_series_reducer = cross_series_reducer
+        self.group_by_fields = group_by_fields
+
+    @classmethod
+    def from_time_series_filter(cls, label: str, metric: str, time_series_filter: dict):
+        """Reads the timeSeriesFilter of a dashboard dataSet, with its aggregation."""
+        aggregation = time_series_filter.get('aggregation', {})
+        return cls(label, metric, time_series_filter['filter'],
+                   per_series_aligner=aggregation.get('perSeriesAligner'),
+                   alignment_period=aggregation.get('alignmentPeriod'),
+                   cross_series_reducer=aggregation.get('crossSeriesReducer'),
+                   group_by_fields=aggregation.get('groupByFields'))
+
+
+def _get_data_set_lines(api, project_id, data_set, start, end, time_interval_display, max_workers):
+    if data_set.per_series_aligner:
+        time_interval_display = copy.copy(time_interval_display)
+        time_interval_display.per_series_aligner = data_set.per_series_aligner
+        time_interval_display.alignment_period = data_set.alignment_period
+    return _get_lines(api, project_id, data_set.metric, start, end, time_interval_display, max_workers,
+                      data_set.cross_series_reducer, data_set.group_by_fields, data_set.filter)
+
+
+def get_collection_from_data_sets(api, project_id, data_sets, start, end, time_interval_display,
+                                  max_workers=None, title=None, executor=None):
+    """Gets one collection of the lines of several data sets, fetched concurrently.
+
+    Unlike get_collection_from_many_metrics, the data sets of a same metric
+    stay apart: each one is fetched with its own filter and aggregation, and
+    its lines are labeled after it when there is more than one.
+
+    Args:
+      data_sets: (list of DataSet)
+      title: (Optional str) Defaults to the labels of the data sets.
+      executor: (Optional futures.Executor) See get_collection_from_many_metrics.
+      The other arguments are the ones of get_collection_from_metrics.
+
+    Raises:
+      ValueError: if none of the data sets has any series.
+    """
+    lines_per_data_set = _map(
+        lambda data_set: _get_data_set_lines(api, project_id, data_set, start, end, time_interval_display,
+                                             max_workers),
+        data_sets, executor)
+
+    if len(data_sets) == 1:
+        lines = lines_per_data_set[0]
+    else:
+        lines = [Line('%s %s' % (data_set.label, line.label), line.xs, line.ys)
+                 for data_set, data_set_lines in zip(data_sets, lines_per_data_set) for line in data_set_lines]
+    if not lines:
+        raise ValueError('no series found', project_id, [data_set.filter for data_set in data_sets], start, end)
+    return Collection(lines=lines, title=title or ', '.join(data_set.label for data_set in data_sets),
+                      start=start, end=end)
@@ -0,0 +1,196 @@
+# Copyright 2015 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#    http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Renders charts to PNG bytes in a pool of warm worker processes.
+
+Rendering is CPU bound, holds the GIL and is not cheap to set up, so the
+charts are rendered out of the bot process: the workers import matplotlib and
+style the chart template as soon as the pool starts, and they only receive a
+compact serialized Collection. The bot process itself never imports matplotlib.
+"""
+
+from concurrent import futures
+from concurrent.futures.process import BrokenProcessPool
+import hashlib
+import logging
+import threading
+
+import charts
+from charts.interval import TimeIntervalDisplay
+
+log = logging.getLogger(__name__)
+
+# The default number of renderers. Each one holds its own matplotlib.
+DEFAULT_PROCESSES = 2
+
+
+def pack_collection(collection):
+    """Serializes a line.Collection to a tuple of plain values and numpy arrays."""
+    band = collection.band
+    return (collection.title, collection.start, collection.end,
+            [(line.label, line.xs, line.ys) for line in collection],
+            (band.label, band.xs, band.lows, band.highs, band.count) if band is not None else None)
+
+
+def unpack_collection(packed):
+    from charts.line import Band, Collection, Line
+
+    title, start, end, lines, band = packed
+    return Collection(lines=[Line(label, xs, ys) for label, xs, ys in lines], title=title, start=start, end=end,
+                      band=Band(*band) if band is not None else None)
+
+
+def chart_digest(collection=None, time_interval_display: TimeIntervalDisplay=None, **kwargs) -> str:
+    """Hashes everything that a rendered chart depends on.
+
+    Two charts with the same digest render to the same PNG, so the digest can be
+    used to name and deduplicate them.
+
+    Args:
+      collection: (Optional line.Collection) The lines of a line chart.
+      time_interval_display: (Optional TimeIntervalDisplay)
+      kwargs: The other chart arguments, e.g. y_formatter or the bar chart arguments.
+
+    Returns:
+      (str) A hex digest.
+    """
+    digest = hashlib.sha256()
+
+    def feed(*values):
+        for value in values:
+            # Functions are hashed by name rather than by their address.
+            value = getattr(value, '__qualname__', value)
+            digest.update(repr(value).encode('utf-8'))
+            digest.update(b'\0')
+
+    if collection is not None:
+        feed(collection.title)
+        for line in collection:
+            feed(line.label)
+            digest.update(line.xs.tobytes())
+            digest.update(line.ys.tobytes())
+        if collection.band is not None:
+            feed(collection.band.label)
+            for values in (collection.band.xs, collection.band.lows, collection.band.highs):
+                digest.update(values.tobytes())
+    if time_interval_display is not None:
+        feed(time_interval_display.tick_minutes,
+             time_interval_display.alignment_period,
+             time_interval_display.per_series_aligner,
+             getattr(time_interval_display.major_formatter, 'fmt', time_interval_display.major_formatter))
+    for name in sorted(kwargs):
+        feed(name, kwargs[name])
+    return digest.hexdigest()
+
+
+# Whether this worker has rendered its first chart yet.
+_warm = False
+
+
+def _warm_up():
+    """Runs once in each worker, before any chart is rendered.
+
+    Rendering a first chart imports matplotlib, builds the styled figure
+    template and loads the font cache.
+    """
+    global _warm
+    if not _warm:
+        charts.generate_barchart(title='', ylabel='', labels=[''], values=[0])
+        _warm = True
+
+
+def _render_linechart(packed_collection, time_interval_display: TimeIntervalDisplay, kwargs):
+    _warm_up()
+    return charts.generate_timeseries_linechart(collection=unpack_collection(packed_collection),
+                                                time_interval_display=time_interval_display, **kwargs)
+
+
+def _render_barchart(kwargs):
+    _warm_up()
+    return charts.generate_barchart(**kwargs)
+
+
+class RenderPool(object):
+    def __init__(self, processes: int=None):
+        """A pool of chart rendering processes.
+
+        Thread safe: any number of commands can render at the same time, up to
+        one chart per process. If a renderer dies, the pool is replaced by a new
+        one rather than staying broken.
+
+        Args:
+          processes: (Optional int) The number of worker processes.
+            Defaults to DEFAULT_PROCESSES.
+        """
+        self.processes = processes or DEFAULT_PROCESSES
+        self._lock = threading.Lock()
+        self._executor = self._new_executor()
+
+    def _new_executor(self):
+        executor = futures.ProcessPoolExecutor(max_workers=self.processes)
+        # Starts every worker now rather than on the first charts, and warms
+        # them up in the background. A worker that picks up no warm up task
+        # warms up on its first chart.
+        for _ in range(self.processes):
+            executor.submit(_warm_up)
+        return executor
+
+    def _submit(self, fn, *args) -> futures.Future:
+        executor = self._executor
+        try:
+            return executor.submit(fn, *args)
+        except BrokenProcessPool:
+            return self._replace(executor).submit(fn, *args)
+
+    def _replace(self, broken):
+        """Replaces a broken executor, once however many threads found it broken."""
+        with self._lock:
+            if self._executor is broken:
+                log.warning('A chart renderer died, restarting the render pool.')
+                broken.shutdown(wait=False)
+                self._executor = self._new_executor()
+            return self._executor
+
+    @staticmethod
+    def _result(submit):
+        """The result of a render, retried once on a new pool if a renderer died during it."""
+        try:
+            return submit().result()
+        except BrokenProcessPool:
+            return submit().result()
+
+    def submit_linechart(self, collection, time_interval_display: TimeIntervalDisplay,
+                         **kwargs) -> futures.Future:
+        """Renders a timeseries line chart, see charts.generate_timeseries_linechart.
+
+        Returns:
+          A Future of the PNG bytes.
+        """
+        return self._submit(_render_linechart, pack_collection(collection), time_interval_display, kwargs)
+
+    def render_linechart(self, collection, time_interval_display: TimeIntervalDisplay,
+                         **kwargs) -> bytes:
+        return self._result(lambda: self.submit_linechart(collection, time_interval_display, **kwargs))
+
+    def submit_barchart(self, **kwargs) -> futures.Future:
+        """Renders a bar chart, see charts.generate_barchart.
+
+        Returns:
+          A Future of the PNG bytes.
+        """
+        return self._submit(_render_barchart, kwargs)
+
+    def render_barchart(self, **kwargs) -> bytes:
+        return self._result(lambda: self.submit_barchart(**kwargs))
+
+    def close(self):
+        self._executor.shutdown(wait=False)
@@ -0,0 +1,87 @@
+# Copyright 2015 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#    http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Keeps the most significant lines of a collection, so that wide charts stay readable."""
+
+import heapq
+
+import numpy as np
+
+from charts.line import Band, Collection, Line
+
+# How the lines can be ranked.
+RANKINGS = ('last', 'max', 'mean')
+
+
+def _scores(collection: Collection, by: str):
+    """Scores every line of a collection, from the 2-D matrix if the lines are aligned."""
+    aligned = collection.aligned()
+    if aligned is not None and aligned[1].shape[1]:
+        ys = aligned[1]
+        if by == 'last':
+            return ys[:, -1]
+        if by == 'max':
+            return np.nanmax(ys, axis=1)
+        return np.nanmean(ys, axis=1)
+
+    reduce = {'last': lambda ys: ys[-1], 'max': np.nanmax, 'mean': np.nanmean}[by]
+    return np.array([reduce(line.ys) if len(line.ys) else -np.inf for line in collection], dtype=np.float64)
+
+
+def envelope(lines, label: str, count: int=None) -> Band:
+    """The min/max envelope of lines, over the union of their xs.
+
+    count is the number of lines enveloped, defaults to len(lines).
+    """
+    all_xs = np.concatenate([line.xs for line in lines])
+    all_ys = np.concatenate([line.ys for line in lines])
+    xs, positions = np.unique(all_xs, return_inverse=True)
+    lows = np.full(len(xs), np.inf)
+    highs = np.full(len(xs), -np.inf)
+    np.minimum.at(lows, positions, all_ys)
+    np.maximum.at(highs, positions, all_ys)
+    return Band(label, xs, lows, highs, len(lines) if count is None else count)
+
+
+def top_k(collection: Collection, k: int, by: str='last') -> Collection:
+    """Keeps the k highest lines of a collection and folds the others into a band.
+
+    Args:
+      collection: (line.Collection)
+      k: (int) The number of lines to keep.
+      by: (Optional str) One of RANKINGS: ranks the lines by their last, max or
+        mean value. Defaults to "last", the value shown in the legend.
+
+    Returns:
+      (line.Collection) The k lines, highest first, with the min/max envelope
+      of the others as its band. The collection itself if it has at most k lines.
+    """
+    if by not in RANKINGS:
+        raise ValueError('unknown ranking', by, RANKINGS)
+    lines = list(collection)
+    if len(lines) <= k:
+        return collection
+
+    scores = _scores(collection, by)
+    scores = np.where(np.isnan(scores), -np.inf, scores)
+    kept = heapq.nlargest(k, range(len(lines)), key=scores.__getitem__)
+    kept_set = set(kept)
+    others = [line for i, line in enumerate(lines) if i not in kept_set and len(line.xs)]
+    folded = len(lines) - k
+    band = collection.band
+    if band is not None:
+        # The lines folded by a previous selection stay in the band.
+        others += [Line('', band.xs, band.lows), Line('', band.xs, band.highs)]
+        folded += band.count
+    band = envelope(others, 'others (%d)' % folded, folded) if others else None
+    return Collection(lines=[lines[i] for i in kept], title=collection.title,
+                      start=collection.start, end=collection.end, band=band)
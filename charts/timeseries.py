@@ -12,12 +12,12 @@
 
 """Pulls data from the Cloud Monitoring Timeseries API."""
 
+from concurrent import futures
 from datetime import timedelta, datetime
 import enum
 import json
-
-from apiclient import discovery
-from oauth2client.client import GoogleCredentials
+import threading
+from typing import Sequence
 
 
 def _format_frequency(time_delta):
@@ -78,9 +78,132 @@ class PerSeriesAligners(enum.Enum):
     FRACTION_TRUE = 'ALIGN_FRACTION_TRUE'
 
 
+class CrossSeriesReducers(enum.Enum):
+    """Combines the aligned time series into fewer series, server side.
+    See: cloud.google.com/monitoring/api/ref_v3/rest/v3/projects.timeSeries/list#Reducer
+    """
+    NONE = 'REDUCE_NONE'
+    MEAN = 'REDUCE_MEAN'
+    MIN = 'REDUCE_MIN'
+    MAX = 'REDUCE_MAX'
+    SUM = 'REDUCE_SUM'
+    STDDEV = 'REDUCE_STDDEV'
+    COUNT = 'REDUCE_COUNT'
+    COUNT_TRUE = 'REDUCE_COUNT_TRUE'
+    FRACTION_TRUE = 'REDUCE_FRACTION_TRUE'
+    PERCENTILE_99 = 'REDUCE_PERCENTILE_99'
+    PERCENTILE_95 = 'REDUCE_PERCENTILE_95'
+    PERCENTILE_50 = 'REDUCE_PERCENTILE_50'
+    PERCENTILE_05 = 'REDUCE_PERCENTILE_05'
+
+
+# The only fields of a timeSeries list response read by the charts. Pass
+# fields=None to list_timeseries to get the full resources.
+TIMESERIES_FIELDS = ('nextPageToken,'
+                     'timeSeries(metric/labels,resource/labels,points(interval/endTime,value))')
+
+
+# Sharding only pays off for long windows: each shard costs a request, and a
+# thread with its own connection. A shard holds at least this many buckets.
+MIN_SHARD_BUCKETS = 240
+
+# The sampling period assumed for the unaligned points, to size their shards.
+_RAW_POINTS_DELTA = timedelta(minutes=1)
+
+
+def _num_shards(start_time, end_time, bucket_delta, max_workers):
+    """The number of shards worth fetching [start_time, end_time] in, at most max_workers."""
+    num_buckets = (end_time - start_time) // (bucket_delta or _RAW_POINTS_DELTA)
+    return max(1, min(max_workers, num_buckets // MIN_SHARD_BUCKETS))
+
+
+def _split_interval(start_time, end_time, bucket_delta, num_shards):
+    """Splits [start_time, end_time] into contiguous sub-windows.
+
+    Each sub-window boundary falls on a multiple of bucket_delta before
+    end_time: the API counts the aligned buckets back from the end of each
+    request, so the buckets of every shard fall on the same offsets as if the
+    whole interval was fetched at once. Only the first shard may be shorter.
+
+    Args:
+      start_time: (datetime) The start of the whole interval.
+      end_time: (datetime) The end of the whole interval.
+      bucket_delta: (Optional timedelta) The alignment period. If None, the
+        interval is split evenly.
+      num_shards: (int) The maximum number of sub-windows to return.
+
+    Returns:
+      A list of (start, end) datetime tuples.
+    """
+    total = end_time - start_time
+    if bucket_delta:
+        num_buckets = max(1, -(-total // bucket_delta))  # Ceiling division.
+        num_shards = min(num_shards, num_buckets)
+        buckets_per_shard = -(-num_buckets // num_shards)
+        shard_delta = bucket_delta * buckets_per_shard
+    else:
+        shard_delta = total / num_shards
+
+    windows = []
+    shard_end = end_time
+    while shard_end > start_time:
+        shard_start = max(shard_end - shard_delta, start_time)
+        windows.append((shard_start, shard_end))
+        shard_end = shard_start
+    windows.reverse()
+    return windows or [(start_time, end_time)]
+
+
+def _series_key(api_series):
+    """Identifies a series by its metric and resource labels."""
+    metric_labels = api_series.get('metric', {}).get('labels', {})
+    resource_labels = api_series.get('resource', {}).get('labels', {})
+    return (tuple(sorted(metric_labels.items())),
+            tuple(sorted(resource_labels.items())))
+
+
+def _stitch_series(shards):
+    """Merges the series of several shards into one series per label key.
+
+    Points found in more than one shard (on a shard boundary) are kept once.
+    """
+    merged = {}
+    seen_end_times = {}
+    for shard in shards:
+        for api_series in shard:
+            key = _series_key(api_series)
+            if key not in merged:
+                merged[key] = dict(api_series, points=[])
+                seen_end_times[key] = set()
+            for point in api_series.get('points', []):
+                end_time = point['interval']['endTime']
+                if end_time in seen_end_times[key]:
+                    continue
+                seen_end_times[key].add(end_time)
+                merged[key]['points'].append(point)
+    return list(merged.values())
+
+
 class Client(object):
-    def __init__(self, monitoring_api_client):
+    def __init__(self, monitoring_api_client, http_factory=None):
+        """A thin wrapper around the Monitoring API timeSeries resource.
+
+        Args:
+          monitoring_api_client: (Monitoring API client)
+          http_factory: (Optional callable) Returns a new authorized http object.
+            Required to run requests on more than one thread, since a single
+            httplib2 connection must not be shared between threads.
+        """
         self._monitoring_api_client = monitoring_api_client
+        self._http_factory = http_factory
+        self._local = threading.local()
+
+    def _execute(self, req):
+        if not self._http_factory:
+            return req.execute()
+        if not hasattr(self._local, 'http'):
+            self._local.http = self._http_factory()
+        return req.execute(http=self._local.http)
 
     def list_timeseries(self,
                         project_id: str,
@@ -88,7 +211,12 @@ class Client(object):
                         start_time: datetime,
                         end_time: datetime,
                         alignment_period: str=AlignmentPeriods.MINUTES_1.value,
-                        per_series_aligner: str=PerSeriesAligners.MAX.value):
+                        per_series_aligner: str=PerSeriesAligners.MAX.value,
+                        max_workers: int=None,
+                        fields: str=TIMESERIES_FIELDS,
+                        cross_series_reducer: str=None,
+                        group_by_fields: Sequence[str]=None,
+                        filter: str=None):
         """Lists time series.
 
         Args:
@@ -125,61 +253,148 @@ class Client(object):
             Defaults to minutely.
           per_series_aligner: The per-series aligner to use.
             Defaults to "ALIGN_MAX".
+          max_workers: (Optional int) If greater than 1, splits long intervals into
+            up to this many alignment period aligned sub-windows of at least
+            MIN_SHARD_BUCKETS buckets and fetches them concurrently. The points of
+            every sub-window are then stitched back into one series per (metric
+            labels, resource labels). Meant for multi-day charts of fine grained
+            points. Defaults to fetching the whole interval sequentially.
+          fields: (Optional str) The partial response selector. Defaults to the
+            fields read by the charts, see TIMESERIES_FIELDS. None returns the full
+            time series resources.
+          cross_series_reducer: (Optional str) E.g., "REDUCE_MEAN". Combines the
+            aligned series of each group into one series, server side, so that
+            a fleet of instances returns a handful of series. Requires a
+            per_series_aligner. Defaults to returning every series.
+          group_by_fields: (Optional list of str) E.g., ["resource.label.zone"].
+            The labels whose values define the groups of the cross_series_reducer.
+            The reduced series only keep these labels. Defaults to a single group.
+          filter: (Optional str) E.g., 'metric.type="..." AND resource.label.zone="us-central1-a"'.
+            The monitoring filter selecting the series, like the one of a dataSet
+            of a dashboard chart. It must select the metric. Defaults to every
+            series of the metric.
 
         Returns:
           timeSeries API response as documented here:
             cloud.google.com/monitoring/api/ref_v3/rest/v3/projects.timeSeries/list
         """
-        out = []
+        return list(self.iter_timeseries(
+            project_id=project_id, metric=metric, start_time=start_time, end_time=end_time,
+            alignment_period=alignment_period, per_series_aligner=per_series_aligner,
+            max_workers=max_workers, fields=fields,
+            cross_series_reducer=cross_series_reducer, group_by_fields=group_by_fields, filter=filter))
 
+    def iter_timeseries(self,
+                        project_id: str,
+                        metric: str,
+                        start_time: datetime,
+                        end_time: datetime,
+                        alignment_period: str=AlignmentPeriods.MINUTES_1.value,
+                        per_series_aligner: str=PerSeriesAligners.MAX.value,
+                        max_workers: int=None,
+                        fields: str=TIMESERIES_FIELDS,
+                        cross_series_reducer: str=None,
+                        group_by_fields: Sequence[str]=None,
+                        filter: str=None):
+        """Same as list_timeseries, but yields each time series as its page arrives.
+
+        Only one page of raw time series is held in memory at a time, and the next
+        page is only requested once the previous one is consumed. Except when the
+        interval is sharded, see max_workers: the series of every shard must all
+        be fetched to be stitched.
+        """
+        bucket_delta = None
         each_value_represents_a_time_bucket = (
             per_series_aligner and
             per_series_aligner != PerSeriesAligners.NONE.value
         )
+        if cross_series_reducer and not each_value_represents_a_time_bucket:
+            raise ValueError('a cross series reducer needs a per series aligner',
+                             cross_series_reducer, per_series_aligner)
         if each_value_represents_a_time_bucket:
             bucket_delta = _alignment_period_string_to_delta(alignment_period)
             start_time -= bucket_delta
 
         default_request_kwargs = dict(
             name='projects/{}'.format(project_id),
-            filter='metric.type="{}"'.format(metric),
+            filter=filter or 'metric.type="{}"'.format(metric),
             pageSize=10000,
-            interval_startTime=_RFC3339(start_time),
-            interval_endTime=_RFC3339(end_time)
         )
+        if fields:
+            default_request_kwargs['fields'] = fields
         if alignment_period:
             default_request_kwargs['aggregation_alignmentPeriod'] = alignment_period
         if per_series_aligner:
             default_request_kwargs['aggregation_perSeriesAligner'] = per_series_aligner
+        if cross_series_reducer:
+            default_request_kwargs['aggregation_crossSeriesReducer'] = cross_series_reducer
+            if group_by_fields:
+                default_request_kwargs['aggregation_groupByFields'] = list(group_by_fields)
+
+        windows = [(start_time, end_time)]
+        num_shards = _num_shards(start_time, end_time, bucket_delta, max_workers) if max_workers else 1
+        if num_shards > 1:
+            windows = _split_interval(start_time, end_time, bucket_delta, num_shards)
+        if len(windows) == 1:
+            yield from self._iter_window(default_request_kwargs, start_time, end_time)
+            return
+
+        with futures.ThreadPoolExecutor(max_workers=len(windows)) as executor:
+            shards = executor.map(
+                lambda window: list(self._iter_window(default_request_kwargs, *window)), windows)
+            yield from _stitch_series(shards)
+
+    def _iter_window(self, default_request_kwargs, start_time, end_time):
+        """Yields the time series of every page in [start_time, end_time]."""
+        default_request_kwargs = dict(
+            default_request_kwargs,
+            interval_startTime=_RFC3339(start_time),
+            interval_endTime=_RFC3339(end_time)
+        )
 
         def _do_request(next_page_token=None):
             kwargs = default_request_kwargs.copy()
             if next_page_token:
                 kwargs['pageToken'] = next_page_token
             req = self._monitoring_api_client.projects().timeSeries().list(**kwargs)
-            return req.execute()
-
-        response = _do_request()
-        out.extend(response.get('timeSeries', []))
+            return self._execute(req)
 
-        next_token = response.get('nextPageToken')
-        while next_token:
+        next_token = None
+        while True:
             response = _do_request(next_token)
-            out.extend(response.get('timeSeries', []))
+            page = response.get('timeSeries', [])
+            # Hands over each series so that the caller can drop it once decoded.
+            page.reverse()
+            while page:
+                yield page.pop()
             next_token = response.get('nextPageToken')
-
-        return out
+            if not next_token:
+                break
 
 
 def _RFC3339(my_datetime):
     return my_datetime.isoformat("T") + "Z"
 
 
+def _parse_RFC3339(rfc_string):
+    """Parses an RFC3339 UTC timestamp, with or without fractional seconds."""
+    seconds, _, fraction = rfc_string.rstrip('Z').partition('.')
+    dt = datetime.strptime(seconds, '%Y-%m-%dT%H:%M:%S')
+    if fraction:
+        dt = dt.replace(microsecond=int(fraction[:6].ljust(6, '0')))
+    return dt
+
+
 def new_client(credentials=None):
+    # The plugins build their clients with gcloudhttp, only this script needs these.
+    import httplib2
+    from apiclient import discovery
+    from oauth2client.client import GoogleCredentials
+
     if not credentials:
         credentials = GoogleCredentials.get_application_default()
     monitoring = discovery.build('monitoring', 'v3', credentials=credentials)
-    return Client(monitoring)
+    return Client(monitoring, http_factory=lambda: credentials.authorize(httplib2.Http()))
 
 
 if __name__ == '__main__':
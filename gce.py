@@ -14,7 +14,6 @@
 from datetime import datetime
 
 from errbot import botcmd, BotPlugin
-from googleapiclient.discovery import build
 
 
 def get_ts():
@@ -33,7 +32,7 @@ class GoogleCloudCompute(BotPlugin):
             self.log.error('FATAL: GCloud plugin could not load credentials.')
             return
 
-        self.compute = build('compute', 'v1', credentials=self.credentials)
+        self.compute = self.gc.build('compute', 'v1')
 
     def project(self):
         if 'project' not in self.gc:
@@ -10,20 +10,28 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import io
 import logging
 import os
 import uuid
 
 import requests
 from errbot import BotPlugin, botcmd, cmdfilter, version
-from googleapiclient.discovery import build
-from matplotlib import use
-use('Agg')
+from googleapiclient.errors import HttpError
+from googleapiclient.http import MediaIoBaseUpload
 from oauth2client.client import GoogleCredentials
 from python_analytics import Tracker, Event
 from threadpool import WorkRequest
 
+import gcloudhttp
+import gcloudutils
+from charts import render
 
+# Number of uploaded charts whose links are remembered, by content digest.
+CHART_LINKS_CACHE_SIZE = 1024
+
+# The only field of an uploaded chart object read by the plugins.
+UPLOAD_FIELDS = 'mediaLink'
 
 
 class GoogleCloud(BotPlugin):
@@ -31,7 +39,11 @@ class GoogleCloud(BotPlugin):
         super().__init__(bot)
         self.outdir = None
         self.credentials = None
+        self.transport = None
         self.storage = None
+        self.renderer = None
+        self.chart_links = gcloudutils.LRUCache(CHART_LINKS_CACHE_SIZE)
+        self.keep_charts = False
 
     """This is a common common for Google Cloud plugins."""
 
@@ -48,7 +60,107 @@ class GoogleCloud(BotPlugin):
             servacc_file = os.path.join(self.outdir, 'servacc.json')
 
         self.credentials = GoogleCredentials.from_stream(servacc_file)
-        self.storage = build('storage', 'v1', credentials=self.credentials)
+        # All the Google Cloud plugins get their API clients from this transport.
+        discovery_cache = gcloudhttp.DiscoveryCache(os.path.join(self.outdir, 'discovery'))
+        self.transport = gcloudhttp.Transport(self.credentials, discovery_cache=discovery_cache)
+        self.storage = self.build('storage', 'v1')
+
+        # Charts are uploaded from memory, set GOOGLE_KEEP_CHARTS to also save them in BOT_DATA_DIR.
+        try:
+            self.keep_charts = self.bot_config.GOOGLE_KEEP_CHARTS
+        except AttributeError:
+            self.keep_charts = False
+
+        try:
+            processes = self.bot_config.GOOGLE_CHART_RENDERERS
+        except AttributeError:
+            processes = None
+        # Neither blocks the activation: the renderers import matplotlib in their
+        # own processes, and numpy is imported here before the first chart needs it.
+        self.renderer = render.RenderPool(processes)
+        gcloudutils.preload('charts.line')
+
+    def deactivate(self):
+        if self.renderer:
+            self.renderer.close()
+            self.renderer = None
+        super().deactivate()
+
+    def build(self, service_name: str, version: str):
+        """Builds a thread safe Google API client, see gcloudhttp.Transport."""
+        return self.transport.build(service_name, version)
+
+    def chart_link(self, bucket: str, prefix: str, digest: str, render_png) -> str:
+        """Gets the link of a chart, rendering and uploading it only if its content is new.
+
+        Charts are named after their content digest, so the same chart is stored
+        once in the bucket: its link is reused from memory, or from the object
+        already in the bucket after a restart. Uploading it again would change
+        its generation and break the links posted before.
+
+        Args:
+          bucket: (str) The bucket to upload to.
+          prefix: (str) The beginning of the uploaded object name.
+          digest: (str) The content digest of the chart, see charts.render.chart_digest.
+          render_png: (callable) Renders the chart to PNG bytes.
+
+        Returns:
+          (str) The media link of the uploaded chart.
+        """
+        key = (bucket, digest)
+        link = self.chart_links.get(key)
+        if link:
+            return link
+
+        filename = '%s.%s.png' % (prefix, digest)
+        link = self._uploaded_link(bucket, filename)
+        if link is None:
+            png = render_png()
+            if self.keep_charts:
+                with open(os.path.join(self.outdir, filename), 'wb') as f:
+                    f.write(png)
+            try:
+                # Only creates the object, in case another bot uploaded it meanwhile.
+                link = self.upload_chart(bucket, filename, png, if_generation_match=0)['mediaLink']
+            except HttpError as e:
+                if e.resp.status != 412:
+                    raise
+                link = self._uploaded_link(bucket, filename)
+        self.chart_links.put(key, link)
+        return link
+
+    def _uploaded_link(self, bucket: str, filename: str):
+        """The media link of an object in the bucket, None if there is no such object."""
+        try:
+            uploaded = self.storage.objects().get(bucket=bucket, object=filename, fields=UPLOAD_FIELDS).execute()
+            return uploaded['mediaLink']
+        except HttpError as e:
+            if e.resp.status == 404:
+                return None
+            raise
+
+    def upload_chart(self, bucket: str, filename: str, png: bytes, fields: str=UPLOAD_FIELDS,
+                     if_generation_match: int=None):
+        """Uploads a PNG chart publicly, straight from memory.
+
+        Args:
+          bucket: (str) The bucket to upload to.
+          filename: (str) The name of the object.
+          png: (bytes) The PNG to upload.
+          fields: (Optional str) The fields of the uploaded object to return.
+            Defaults to its media link. None returns all of them.
+          if_generation_match: (Optional int) Only uploads over this generation
+            of the object, 0 only if there is no such object yet. The upload
+            fails with an HTTP 412 otherwise.
+        """
+        with io.BytesIO(png) as source:
+            media = MediaIoBaseUpload(source, mimetype='image/png')
+            return self.storage.objects().insert(bucket=bucket,
+                                                 name=filename,
+                                                 media_body=media,
+                                                 predefinedAcl='publicRead',
+                                                 ifGenerationMatch=if_generation_match,
+                                                 fields=fields).execute()
 
     @botcmd(split_args_with=' ')
     def project_set(self, mess, args):
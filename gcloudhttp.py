@@ -0,0 +1,152 @@
+# Copyright 2015 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#    http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""A thread safe HTTP transport shared by the Google API clients."""
+
+import json
+import logging
+import os
+import threading
+
+import httplib2
+from googleapiclient.discovery import build_from_document
+from googleapiclient.http import HttpRequest
+
+try:
+    from googleapiclient.discovery_cache import get_static_doc
+except ImportError:  # Older google-api-python-client releases don't bundle the documents.
+    get_static_doc = None
+
+DISCOVERY_URL = 'https://www.googleapis.com/discovery/v1/apis/{api}/{version}/rest'
+
+log = logging.getLogger(__name__)
+
+# (api, version) -> parsed discovery document, shared by every plugin of the process.
+_DOCUMENTS = {}
+_DOCUMENTS_LOCK = threading.Lock()
+
+
+class DiscoveryCache(object):
+    def __init__(self, cache_dir: str=None):
+        """Discovery documents, parsed once per process and stored on disk.
+
+        Documents are looked up in memory, then in cache_dir, then in the
+        documents bundled with google-api-python-client, and only then fetched.
+        This makes building API clients fast and possible offline.
+
+        Args:
+          cache_dir: (Optional str) Where to store the documents, e.g. under
+            BOT_DATA_DIR. Defaults to not storing them on disk.
+        """
+        self.cache_dir = cache_dir
+
+    def _path(self, api: str, version: str):
+        return os.path.join(self.cache_dir, '%s.%s.json' % (api, version))
+
+    def _load(self, api: str, version: str, http):
+        if self.cache_dir:
+            try:
+                with open(self._path(api, version)) as f:
+                    return f.read()
+            except OSError:
+                pass
+
+        content = get_static_doc(api, version) if get_static_doc else None
+        if content is None:
+            response, content = http.request(DISCOVERY_URL.format(api=api, version=version))
+            if response.status >= 400:
+                raise ValueError('could not fetch the discovery document', api, version, response.status)
+            content = content.decode('utf-8')
+
+        if self.cache_dir:
+            try:
+                os.makedirs(self.cache_dir, exist_ok=True)
+                tmp = self._path(api, version) + '.tmp'
+                with open(tmp, 'w') as f:
+                    f.write(content)
+                os.replace(tmp, self._path(api, version))
+            except OSError:
+                log.exception('Could not store the discovery document of %s %s.', api, version)
+        return content
+
+    def get(self, api: str, version: str, http) -> dict:
+        """Gets the parsed discovery document of an API.
+
+        Args:
+          api: (str) E.g., "monitoring".
+          version: (str) E.g., "v3".
+          http: (httplib2.Http) Used only if the document must be fetched.
+        """
+        key = (api, version)
+        with _DOCUMENTS_LOCK:
+            document = _DOCUMENTS.get(key)
+            if document is None:
+                document = _DOCUMENTS[key] = json.loads(self._load(api, version, http))
+            return document
+
+
+class _GzipHttp(httplib2.Http):
+    """Asks for gzip compressed responses.
+
+    Google APIs only compress the responses of the clients that both accept
+    gzip and mention it in their user agent.
+    """
+
+    def request(self, uri, method='GET', body=None, headers=None, *args, **kwargs):
+        headers = dict(headers or {})
+        headers.setdefault('accept-encoding', 'gzip')
+        user_agent = headers.get('user-agent', '')
+        if 'gzip' not in user_agent:
+            headers['user-agent'] = (user_agent + ' (gzip)').strip()
+        return super().request(uri, method, body, headers, *args, **kwargs)
+
+
+class Transport(object):
+    def __init__(self, credentials, timeout: float=None, discovery_cache: DiscoveryCache=None):
+        """Authorized HTTP connections, one per thread.
+
+        httplib2.Http objects are not thread safe, so sharing one between the
+        API clients either serializes the commands or corrupts the connection.
+        Each thread gets its own authorized Http instead, which keeps its
+        connections alive between requests.
+
+        Args:
+          credentials: (oauth2client.client.GoogleCredentials)
+          timeout: (Optional float) The socket timeout in seconds.
+          discovery_cache: (Optional DiscoveryCache) Where the discovery documents
+            come from. Defaults to a cache in memory only.
+        """
+        self.credentials = credentials
+        self.timeout = timeout
+        self.discovery_cache = discovery_cache or DiscoveryCache()
+        self._local = threading.local()
+
+    def http(self):
+        """Gets the authorized http object of the current thread."""
+        http = getattr(self._local, 'http', None)
+        if http is None:
+            http = self._local.http = self.credentials.authorize(_GzipHttp(timeout=self.timeout))
+        return http
+
+    def _request_builder(self, http, *args, **kwargs):
+        # Requests run on the thread that creates them, with that thread's http.
+        return HttpRequest(self.http(), *args, **kwargs)
+
+    def build(self, service_name: str, version: str):
+        """Builds an API client whose requests use the http of the calling thread.
+
+        Args:
+          service_name: (str) E.g., "monitoring".
+          version: (str) E.g., "v3".
+        """
+        document = self.discovery_cache.get(service_name, version, self.http())
+        return build_from_document(document, http=self.http(), requestBuilder=self._request_builder)
@@ -10,7 +10,19 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import collections
 import datetime
+import heapq
+import importlib
+import itertools
+import logging
+import queue
+import random
+import threading
+from concurrent import futures
+import time
+
+log = logging.getLogger(__name__)
 
 ONE_MINUTE = datetime.timedelta(minutes=1)
 FIVE_MINUTES = datetime.timedelta(minutes=5)
@@ -36,3 +48,280 @@ def round_time(dt: datetime.datetime, delta: datetime.timedelta = FIVE_MINUTES,
     if round_up:
         return out if out >= dt else out + delta
     return out if out <= dt else out - delta
+
+
+class LRUCache(object):
+    """A thread safe mapping that keeps only its most recently used entries.
+
+    Args:
+      max_entries: (int) The number of entries to keep.
+      ttl: (Optional float) The number of seconds after which an entry expires.
+        Defaults to never.
+      max_bytes: (Optional int) The approximate memory budget of the entries,
+        measured with sizeof. A value bigger than the whole budget is not kept.
+        Defaults to no budget.
+      sizeof: (Optional callable) Returns the approximate size of a value in
+        bytes. Required with max_bytes.
+    """
+
+    def __init__(self, max_entries: int, ttl: float = None, max_bytes: int = None, sizeof=None):
+        if max_bytes is not None and sizeof is None:
+            raise ValueError('max_bytes needs a sizeof')
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self._sizeof = sizeof
+        # key -> (stored at, value, size)
+        self._entries = collections.OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._entries:
+                return default
+            stored_at, value, _ = self._entries[key]
+            if self.ttl is not None and time.monotonic() - stored_at > self.ttl:
+                self._remove(key)
+                return default
+            self._entries.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        size = self._sizeof(value) if self.max_bytes is not None else 0
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            if self.max_bytes is not None and size > self.max_bytes:
+                return
+            self._entries[key] = (time.monotonic(), value, size)
+            self._bytes += size
+            while len(self._entries) > self.max_entries or \
+                    (self.max_bytes is not None and self._bytes > self.max_bytes):
+                self._remove(next(iter(self._entries)))
+
+    def pop(self, key, default=None):
+        with self._lock:
+            if key not in self._entries:
+                return default
+            return self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def _remove(self, key):
+        _, value, size = self._entries.pop(key)
+        self._bytes -= size
+        return value
+
+    def __contains__(self, key):
+        return self.get(key, self) is not self
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class CoalescingQueue(object):
+    """Runs jobs on a bounded pool of threads, merging the duplicates.
+
+    The first job of a key runs right away, and the jobs submitted within
+    window seconds of its start with the same key are merged into a single
+    job, run at the end of the window: the last payload wins. A burst of
+    identical requests thus costs at most two runs, and the load grows with
+    the number of distinct keys rather than with the number of requests.
+    Thread safe.
+
+    Args:
+      handler: (callable) Called with the payload of each job, on a worker thread.
+      workers: (Optional int) The number of worker threads. Defaults to 2.
+      window: (Optional float) The number of seconds during which duplicate jobs
+        are merged. Defaults to 10.
+      max_pending: (Optional int) The number of distinct jobs that can wait at
+        the same time. Defaults to 1000.
+    """
+
+    def __init__(self, handler, workers: int = 2, window: float = 10, max_pending: int = 1000):
+        self.window = window
+        self.max_pending = max_pending
+        self._handler = handler
+        # key -> [payload, number of merged submissions]
+        self._pending = {}
+        # (due, sequence number, key) of the pending jobs.
+        self._due = []
+        self._sequence = itertools.count()
+        # key -> when its last job started, for the keys started within the window.
+        self._started = {}
+        self._changed = threading.Condition()
+        self._closed = False
+        self._workers = [threading.Thread(target=self._work, name='CoalescingQueue worker', daemon=True)
+                         for _ in range(workers)]
+        for worker in self._workers:
+            worker.start()
+
+    def submit(self, key, payload) -> bool:
+        """Queues a job, or merges it into the pending job with the same key.
+
+        Returns:
+          (bool) Whether a new job was queued.
+
+        Raises:
+          queue.Full: if max_pending distinct jobs are already waiting.
+        """
+        with self._changed:
+            job = self._pending.get(key)
+            if job is not None:
+                job[0] = payload
+                job[1] += 1
+                return False
+            if len(self._pending) >= self.max_pending:
+                raise queue.Full()
+            now = time.monotonic()
+            if len(self._started) > self.max_pending:
+                self._started = {k: t for k, t in self._started.items() if now - t < self.window}
+            started = self._started.get(key)
+            due = now if started is None else max(now, started + self.window)
+            heapq.heappush(self._due, (due, next(self._sequence), key))
+            self._pending[key] = [payload, 1]
+            self._changed.notify()
+            return True
+
+    def _next_job(self):
+        """Waits for the next job that is due, None once closed."""
+        with self._changed:
+            while not self._closed:
+                timeout = None
+                if self._due:
+                    due, _, key = self._due[0]
+                    now = time.monotonic()
+                    if due <= now:
+                        heapq.heappop(self._due)
+                        self._started[key] = now
+                        return key, self._pending.pop(key)
+                    timeout = due - now
+                self._changed.wait(timeout)
+            return None
+
+    def _work(self):
+        while True:
+            job = self._next_job()
+            if job is None:
+                return
+            key, (payload, count) = job
+            if count > 1:
+                log.debug('Merged %d submissions of %s.', count, key)
+            try:
+                self._handler(payload)
+            except Exception:
+                log.exception('Job %s failed.', key)
+
+    def close(self):
+        """Stops the workers, dropping the pending jobs."""
+        with self._changed:
+            self._closed = True
+            self._changed.notify_all()
+
+    def __len__(self):
+        return len(self._pending)
+
+
+class RefreshScheduler(object):
+    """Refreshes a changing set of keys periodically, in the background.
+
+    The first refreshes are spread over a whole period and each next one is
+    delayed by the period plus or minus some jitter, so that the refreshes
+    never come in bursts. At most workers refreshes run at the same time, and
+    a key is never refreshed twice at the same time.
+
+    Args:
+      refresh: (callable) Called with a key, on a worker thread.
+      keys: (callable) Returns the keys to refresh. Called whenever a refresh
+        is due, at least once per period and on wake, so that the new keys are
+        picked up and the removed ones dropped.
+      period: (float) The number of seconds between two refreshes of a key.
+      workers: (Optional int) The number of refreshes that can run at the same
+        time. Defaults to 2.
+      jitter: (Optional float) The fraction of the period by which the
+        refreshes are randomly delayed or advanced. Defaults to 0.1.
+    """
+
+    def __init__(self, refresh, keys, period: float, workers: int = 2, jitter: float = 0.1):
+        self.period = period
+        self.jitter = jitter
+        self._refresh = refresh
+        self._keys = keys
+        # key -> monotonic time of its next refresh.
+        self._due = {}
+        self._running = set()
+        self._lock = threading.Lock()
+        self._stopped = False
+        self._wakeup = threading.Event()
+        self._executor = futures.ThreadPoolExecutor(max_workers=workers)
+        self._thread = threading.Thread(target=self._run, name='RefreshScheduler', daemon=True)
+        self._thread.start()
+
+    def _next(self, now):
+        return now + self.period * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+    def _run(self):
+        while not self._stopped:
+            # A wake up from now on lists the keys again.
+            self._wakeup.clear()
+            try:
+                keys = set(self._keys())
+            except Exception:
+                log.exception('Could not list the keys to refresh.')
+                keys = set(self._due)
+
+            now = time.monotonic()
+            with self._lock:
+                for key in set(self._due) - keys:
+                    del self._due[key]
+                for key in keys - set(self._due):
+                    self._due[key] = now + random.uniform(0, self.period)
+                for key, due in self._due.items():
+                    if due <= now and key not in self._running:
+                        self._running.add(key)
+                        self._due[key] = self._next(now)
+                        self._executor.submit(self._run_one, key)
+                next_due = min(self._due.values(), default=now + self.period)
+
+            self._wakeup.wait(min(max(0, next_due - now), self.period))
+
+    def _run_one(self, key):
+        try:
+            self._refresh(key)
+        except Exception:
+            log.exception('Could not refresh %s.', key)
+        finally:
+            with self._lock:
+                self._running.discard(key)
+
+    def wake(self):
+        """Lists the keys again now rather than when the next refresh is due."""
+        self._wakeup.set()
+
+    def close(self):
+        self._stopped = True
+        self._wakeup.set()
+        self._executor.shutdown(wait=False)
+
+
+def preload(*module_names: str) -> threading.Thread:
+    """Imports modules in a background thread.
+
+    For the heavy modules that only some commands need: they are imported lazily
+    by those commands, and ahead of time by this so that the first one is fast.
+    """
+
+    def _import():
+        for name in module_names:
+            try:
+                importlib.import_module(name)
+            except ImportError:
+                log.exception('Could not preload %s.', name)
+
+    thread = threading.Thread(target=_import, name='preload', daemon=True)
+    thread.start()
+    return thread
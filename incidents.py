@@ -0,0 +1,126 @@
+# Copyright 2015 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#    http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""An in-memory index of the Stackdriver incidents, digested periodically."""
+
+import collections
+import threading
+import time
+
+OPEN = 'open'
+CLOSED = 'closed'
+STATES = (OPEN, CLOSED)
+
+# The fields of an incident kept by the index.
+INCIDENT_FIELDS = ('incident_id', 'state', 'policy_name', 'condition_name', 'resource_name',
+                   'summary', 'url', 'started_at', 'ended_at')
+
+
+class Digest(object):
+    def __init__(self, opened, closed, open_count):
+        """The incidents opened and closed since the previous digest.
+
+        An incident opened and closed between two digests is only in closed.
+
+        Args:
+          opened: (list of dict) The incidents still open.
+          closed: (list of dict) The incidents closed.
+          open_count: (int) The number of incidents open in total.
+        """
+        self.opened = opened
+        self.closed = closed
+        self.open_count = open_count
+
+    def __bool__(self):
+        return bool(self.opened or self.closed)
+
+
+class IncidentIndex(object):
+    def __init__(self, retention: float=24 * 60 * 60):
+        """The incidents keyed by incident_id, with their last known state.
+
+        Transitions are idempotent: the retries of a notification don't change
+        anything, and a late "open" for a closed incident is ignored, since
+        Stackdriver opens a new incident for a new violation.
+        Thread safe.
+
+        Args:
+          retention: (Optional float) Seconds during which a closed incident is
+            remembered, to ignore its retries. Defaults to a day.
+        """
+        self.retention = retention
+        self._incidents = {}
+        # incident_id -> monotonic time it was closed at, oldest first.
+        self._closed_at = collections.OrderedDict()
+        # The incident_ids changed since the last digest, in order.
+        self._changed = collections.OrderedDict()
+        self._open_count = 0
+        self._lock = threading.Lock()
+
+    def apply(self, incident: dict) -> bool:
+        """Applies a Stackdriver incident notification.
+
+        Args:
+          incident: (dict) The "incident" of the notification.
+
+        Returns:
+          (bool) Whether the incident changed state.
+
+        Raises:
+          ValueError: if the incident has no incident_id or an unknown state.
+        """
+        incident_id = incident.get('incident_id')
+        state = incident.get('state')
+        if not incident_id or state not in STATES:
+            raise ValueError('invalid incident', incident_id, state)
+
+        with self._lock:
+            known = self._incidents.get(incident_id)
+            if known is not None and (known['state'] == state or known['state'] == CLOSED):
+                return False
+            self._incidents[incident_id] = {field: incident.get(field) for field in INCIDENT_FIELDS}
+            self._changed[incident_id] = None
+            if state == OPEN:
+                self._open_count += 1
+            else:
+                if known is not None:
+                    self._open_count -= 1
+                self._closed_at[incident_id] = time.monotonic()
+            return True
+
+    def get(self, incident_id: str):
+        with self._lock:
+            return self._incidents.get(incident_id)
+
+    def open_incidents(self):
+        with self._lock:
+            return [incident for incident in self._incidents.values() if incident['state'] == OPEN]
+
+    def digest(self) -> Digest:
+        """Returns the changes since the previous digest and forgets the old closed incidents."""
+        with self._lock:
+            changed = [self._incidents[incident_id] for incident_id in self._changed]
+            self._changed = collections.OrderedDict()
+            self._expire()
+            open_count = self._open_count
+        return Digest(opened=[incident for incident in changed if incident['state'] == OPEN],
+                      closed=[incident for incident in changed if incident['state'] == CLOSED],
+                      open_count=open_count)
+
+    def _expire(self):
+        oldest = time.monotonic() - self.retention
+        while self._closed_at and next(iter(self._closed_at.values())) < oldest:
+            incident_id, _ = self._closed_at.popitem(last=False)
+            del self._incidents[incident_id]
+
+    def __len__(self):
+        return len(self._incidents)
@@ -9,24 +9,71 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
-import os
+import json
 import pprint
+import queue
+import re
+import time
+from concurrent import futures
 from datetime import datetime, timedelta
 
 from errbot import Message, webhook
-from errbot import botcmd, BotPlugin
-from googleapiclient.discovery import build
-from googleapiclient.http import MediaIoBaseUpload
+from errbot import arg_botcmd, botcmd, BotPlugin
 
-import charts
-import charts.line
-import charts.timeseries
-from charts import interval, line, timeseries
+import charts.render
+import gcloudutils
+import incidents
+from charts import cache, descriptors, interval, timeseries
 
 
-def get_ts():
-    now = datetime.now()
-    return '%s.%d' % (now.strftime('%Y%m%d-%H%M%S'), now.microsecond)
+# Number of time shards fetched concurrently for a single long chart, None to never shard.
+DEFAULT_FETCH_WORKERS = None
+
+# Number of metrics or data sets fetched concurrently, by long-lived threads, for all the charts.
+DEFAULT_FETCH_THREADS = 8
+
+# Number of series drawn in a chart, the others are folded into an "others" band.
+DEFAULT_CHART_LINES = 10
+
+# How often the metric descriptor indexes are reloaded in the background.
+DESCRIPTORS_REFRESH_SECONDS = 10 * 60
+
+# Number of dashboard charts rendered concurrently for the stackdriver webhook.
+DEFAULT_WEBHOOK_WORKERS = 2
+
+# Seconds during which the webhook requests for the same filter are merged into one chart.
+DEFAULT_WEBHOOK_WINDOW = 10
+
+# Number of bookmarked charts pre-rendered at the same time, see GOOGLE_MONITORING_PRERENDER_SECONDS.
+DEFAULT_PRERENDER_WORKERS = 2
+
+# How often the incidents received by the alert webhook are posted as a digest.
+DEFAULT_INCIDENTS_DIGEST_SECONDS = 60
+
+# The room the incidents digest is posted to.
+DEFAULT_INCIDENTS_ROOM = 'google'
+
+# Number of incidents listed in a digest card, the others are only counted.
+INCIDENTS_DIGEST_MAX_LINES = 20
+
+_METRIC_TYPE_FILTER = re.compile(r'metric\.type\s*=\s*\\?"([^"\\]+)\\?"')
+
+# The label prefixes and quotes left out of the data set labels.
+_FILTER_NOISE = re.compile(r'\b(?:resource|metric)\.labels?\.|\\?"')
+
+
+def _group_by_field(name):
+    """E.g., "resource.label.zone" for "zone": bare names are resource labels."""
+    return name if '.' in name else 'resource.label.' + name
+
+
+def _data_set_label(filter, metric_type):
+    """E.g., "cpu/utilization zone=us-central1-a": the metric and the other clauses of a filter."""
+    short_name = '/'.join(metric_type.split('/')[-2:])
+    clauses = [clause.strip() for clause in re.split(r'\s+AND\s+', filter)]
+    others = [_FILTER_NOISE.sub('', clause).replace(' ', '') for clause in clauses
+              if clause and not _METRIC_TYPE_FILTER.search(clause)]
+    return ' '.join([short_name] + others)
 
 
 class GoogleCloudMonitoring(BotPlugin):
@@ -42,7 +89,78 @@ class GoogleCloudMonitoring(BotPlugin):
         if 'bookmarks' not in self:
             self['bookmarks'] = []
 
-        self.monitoring = build('monitoring', 'v3', credentials=self.credentials)
+        self.monitoring = self.gc.build('monitoring', 'v3')
+
+        try:
+            self.fetch_workers = self.bot_config.GOOGLE_MONITORING_FETCH_WORKERS
+        except AttributeError:
+            self.fetch_workers = DEFAULT_FETCH_WORKERS
+        try:
+            fetch_threads = self.bot_config.GOOGLE_MONITORING_FETCH_THREADS
+        except AttributeError:
+            fetch_threads = DEFAULT_FETCH_THREADS
+        # Its threads keep their connection to the API from one chart to the next.
+        self.fetch_pool = futures.ThreadPoolExecutor(max_workers=fetch_threads)
+        try:
+            self.chart_lines = self.bot_config.GOOGLE_MONITORING_CHART_LINES
+        except AttributeError:
+            self.chart_lines = DEFAULT_CHART_LINES
+
+        self.timeseries_cache = cache.TimeseriesCache()
+
+        self.descriptor_indexes = {}
+        self.start_poller(DESCRIPTORS_REFRESH_SECONDS, self.refresh_descriptors)
+
+        try:
+            webhook_workers = self.bot_config.GOOGLE_MONITORING_WEBHOOK_WORKERS
+        except AttributeError:
+            webhook_workers = DEFAULT_WEBHOOK_WORKERS
+        try:
+            webhook_window = self.bot_config.GOOGLE_MONITORING_WEBHOOK_WINDOW
+        except AttributeError:
+            webhook_window = DEFAULT_WEBHOOK_WINDOW
+        self.dashboard_jobs = gcloudutils.CoalescingQueue(self.post_dashboard_chart,
+                                                          workers=webhook_workers, window=webhook_window)
+
+        self.incidents = incidents.IncidentIndex()
+        try:
+            digest_seconds = self.bot_config.GOOGLE_MONITORING_INCIDENTS_DIGEST_SECONDS
+        except AttributeError:
+            digest_seconds = DEFAULT_INCIDENTS_DIGEST_SECONDS
+        try:
+            self.incidents_room = self.bot_config.GOOGLE_MONITORING_INCIDENTS_ROOM
+        except AttributeError:
+            self.incidents_room = DEFAULT_INCIDENTS_ROOM
+        self.start_poller(digest_seconds, self.post_incidents_digest)
+
+        # Optionally, the bookmarked charts are rendered ahead of !metric chart.
+        self.prerendered = {}
+        self.prerenderer = None
+        try:
+            self.prerender_seconds = self.bot_config.GOOGLE_MONITORING_PRERENDER_SECONDS
+        except AttributeError:
+            self.prerender_seconds = None
+        if self.prerender_seconds:
+            try:
+                prerender_workers = self.bot_config.GOOGLE_MONITORING_PRERENDER_WORKERS
+            except AttributeError:
+                prerender_workers = DEFAULT_PRERENDER_WORKERS
+            self.prerenderer = gcloudutils.RefreshScheduler(self.prerender_bookmark, self.prerender_keys,
+                                                            self.prerender_seconds, workers=prerender_workers)
+
+    def deactivate(self):
+        # Not created if the activation stopped early.
+        if getattr(self, 'dashboard_jobs', None):
+            self.dashboard_jobs.close()
+        if getattr(self, 'prerenderer', None):
+            self.prerenderer.close()
+        if getattr(self, 'fetch_pool', None):
+            self.fetch_pool.shutdown(wait=False)
+        super().deactivate()
+
+    def timeseries_client(self):
+        # The sharded fetches are thread safe: the requests use the http of their worker thread.
+        return cache.CachingClient(timeseries.Client(self.monitoring), self.timeseries_cache)
 
     def project(self):
         if 'project' not in self.gc:
@@ -54,15 +172,79 @@ class GoogleCloudMonitoring(BotPlugin):
             raise Exception('No Bucket set.')
         return self.gc['bucket']
 
-    def gen_graph(self, metric, prefix):
-        filename = '%s-%s.%s.png' % (prefix.replace('/', '_'), self.project(), get_ts())
-        output = os.path.join(self.gc.outdir, filename)
-        end = datetime.utcnow() + timedelta(minutes=1)
-        start = end - timedelta(minutes=15)
+    def descriptors(self):
+        """Gets the metric descriptor index of the current project."""
+        project = self.project()
+        index = self.descriptor_indexes.get(project)
+        if index is None:
+            index = self.descriptor_indexes[project] = descriptors.DescriptorIndex(self.monitoring, project)
+        return index
+
+    def refresh_descriptors(self):
+        for index in list(self.descriptor_indexes.values()):
+            try:
+                index.refresh()
+            except Exception:
+                self.log.exception('Could not refresh the metric descriptors of %s.', index.project_id)
+
+    def find_descriptor(self, filter):
+        """Gets the descriptor of the first metric matching a filter or None."""
+        match = _METRIC_TYPE_FILTER.search(filter)
+        if match:
+            return self.descriptors().get(match.group(1))
+        res = self.monitoring.projects().metricDescriptors().list(name='projects/%s' % self.project(),
+                                                                  filter=filter,
+                                                                  fields=descriptors.DESCRIPTOR_FIELDS).execute()
+        metrics = res.get('metricDescriptors', [])
+        return metrics[0] if metrics else None
 
+    def prerender_keys(self):
+        """The (project, metric type) of every bookmark.
+
+        The charts prerendered for the other keys, of a deleted bookmark or of
+        the previous project, are dropped.
+        """
+        if 'project' not in self.gc or 'bucket' not in self.gc:
+            keys = []
+        else:
+            keys = [(self.project(), metric_type) for metric_type in set(self['bookmarks'])]
+        for key in set(self.prerendered) - set(keys):
+            self.prerendered.pop(key, None)
+        return keys
+
+    def prerender_bookmark(self, key):
+        project, metric_type = key
+        if project != self.project():
+            return
+        metric = self.descriptors().get(metric_type)
+        if metric:
+            url = self.gen_graph(metric_type, metric_type)
+            self.prerendered[key] = (metric, url, datetime.now(), time.monotonic())
+
+    def gen_graph(self, metrics, prefix, cross_series_reducer=None, group_by_fields=None, top=None, rank_by='last'):
+        """Charts the last 15 minutes of one or more metrics together and returns the chart link.
+
+        The metrics are fetched concurrently and rendered as a single chart.
+
+        Args:
+          metrics: (str | list of str) The metric types.
+          prefix: (str) The beginning of the uploaded chart name.
+          cross_series_reducer: (Optional str) E.g., "REDUCE_MEAN". Reduces the
+            series server side, one line per group of group_by_fields.
+          group_by_fields: (Optional list of str) E.g., ["resource.label.zone"].
+          top: (Optional int) The number of series to draw, the others are drawn
+            as a min/max band. Defaults to GOOGLE_MONITORING_CHART_LINES.
+          rank_by: (Optional str) How the series are ranked: "last", "max" or "mean".
+            Defaults to their last value.
+        """
+        if isinstance(metrics, str):
+            metrics = [metrics]
+        start, end = self._last_15_minutes()
         tid = interval.guess(start, end)
-        tid.per_series_aligner = None
-        tid.alignment_period = None
+        if not cross_series_reducer:
+            # The raw points, the series can only be reduced once aligned.
+            tid.per_series_aligner = None
+            tid.alignment_period = None
         # These can be used with the default y_formatter:
         # compute.googleapis.com/firewall/dropped_packets_count
         # appengine.googleapis.com/system/cpu/usage
@@ -73,54 +255,66 @@ class GoogleCloudMonitoring(BotPlugin):
         # compute.googleapis.com/instance/network/received_bytes_count
         # Needs y_formatter=_FormatPercent
         # compute.googleapis.com/instance/cpu/utilization
-        collection = line.get_collection_from_metrics(
-            api=timeseries.Client(self.monitoring),
+        from charts import line  # numpy is only imported by the first chart.
+        collection = line.get_collection_from_many_metrics(
+            api=self.timeseries_client(),
             project_id=self.project(),
-            metric=metric,
-            start=start, end=end, time_interval_display=tid)
-        charts.generate_timeseries_linechart(
-            collection=collection,
-            time_interval_display=tid,
-            outfile=output,
-            # y_formatter=_FormatPercent,
-        )
-        with open(output, 'rb') as source:
-            media = MediaIoBaseUpload(source, mimetype='image/png')
-            response = self.gc.storage.objects().insert(bucket=self.bucket(),
-                                                        name=filename,
-                                                        media_body=media,
-                                                        predefinedAcl='publicRead').execute()
-        return response['mediaLink']
+            metrics=metrics,
+            start=start, end=end, time_interval_display=tid,
+            max_workers=self.fetch_workers,
+            cross_series_reducer=cross_series_reducer,
+            group_by_fields=group_by_fields,
+            executor=self.fetch_pool)
+        return self.chart_collection(collection, tid, prefix, top, rank_by)
+
+    def gen_data_sets_graph(self, data_sets, prefix):
+        """Charts the last 15 minutes of the data sets of a dashboard chart and returns the chart link.
+
+        Args:
+          data_sets: (list of line.DataSet) Fetched with their own filter and
+            aggregation, their raw points by default.
+          prefix: (str) The beginning of the uploaded chart name.
+        """
+        start, end = self._last_15_minutes()
+        tid = interval.guess(start, end)
+        tid.per_series_aligner = None
+        tid.alignment_period = None
+        from charts import line
+        collection = line.get_collection_from_data_sets(
+            api=self.timeseries_client(),
+            project_id=self.project(),
+            data_sets=data_sets,
+            start=start, end=end, time_interval_display=tid,
+            max_workers=self.fetch_workers,
+            executor=self.fetch_pool)
+        return self.chart_collection(collection, tid, prefix)
+
+    @staticmethod
+    def _last_15_minutes():
+        end = datetime.utcnow() + timedelta(minutes=1)
+        return end - timedelta(minutes=15), end
+
+    def chart_collection(self, collection, tid, prefix, top=None, rank_by='last'):
+        """Renders a collection once, uploads it and returns the chart link, see gen_graph."""
+        from charts import select
+        # Only the top series are hashed and sent to the renderer, the others
+        # are folded into a band here.
+        collection = select.top_k(collection, top or self.chart_lines, rank_by)
+        digest = charts.render.chart_digest(collection=collection, time_interval_display=tid, max_lines=None)
+        return self.gc.chart_link(
+            self.bucket(), '%s-%s' % (prefix.replace('/', '_'), self.project()), digest,
+            lambda: self.gc.renderer.render_linechart(
+                collection=collection,
+                time_interval_display=tid,
+                # y_formatter=_FormatPercent,
+                max_lines=None
+            ))
 
     @botcmd
     def metric_search(self, msg, args):
         """List the monitoring metrics for the current project.
         """
-        out = []
-
-        default_request_kwargs = dict(
-            name='projects/{}'.format(self.project()),
-        )
-        if args:
-            default_request_kwargs['filter'] = 'metric.type : "%s"' % args
-
-        def _do_request(next_page_token=None):
-            kwargs = default_request_kwargs.copy()
-            if next_page_token:
-                kwargs['pageToken'] = next_page_token
-            req = self.monitoring.projects().metricDescriptors().list(**kwargs)
-            return req.execute()
-
-        response = _do_request()
-        out.extend(response.get('metricDescriptors', []))
-
-        next_token = response.get('nextPageToken')
-        while next_token:
-            response = _do_request(next_token)
-            out.extend(response.get('metricDescriptors', []))
-            next_token = response.get('nextPageToken')
-
-        return '\n'.join('* %s %s' % (m['type'], m['description']) for m in out)
+        return '\n'.join('* %s %s' % (m['type'], m['description']) for m in self.descriptors().search(args))
 
     @botcmd
     def metric_addbookmark(self, _, args: str):
@@ -129,6 +323,8 @@ class GoogleCloudMonitoring(BotPlugin):
         """
         with self.mutable('bookmarks') as bookmarks:
             bookmarks.append(args)
+        if self.prerenderer:
+            self.prerenderer.wake()
         return "Your bookmark has been stored, you can chart it with !metrics chart %i." % (len(bookmarks) - 1)
 
     @botcmd
@@ -145,42 +341,65 @@ class GoogleCloudMonitoring(BotPlugin):
         """
         with self.mutable('bookmarks') as bookmarks:
             del bookmarks[int(args)]
+        if self.prerenderer:
+            # Drops its prerendered chart.
+            self.prerenderer.wake()
         return "%i bookmarks have been defined." % len(bookmarks)
 
-    @botcmd
-    def metric_chart(self, msg: Message, args: str):
-        """ Charts a metric or a bookmark of a metric.
+    @arg_botcmd('metrics', type=str, nargs='+')
+    @arg_botcmd('--reduce', dest='reduce', type=str,
+                choices=[r.name.lower() for r in timeseries.CrossSeriesReducers if r.name != 'NONE'])
+    @arg_botcmd('--group-by', dest='group_by', type=str)
+    @arg_botcmd('--top', dest='top', type=int)
+    @arg_botcmd('--by', dest='rank_by', type=str, default='last', choices=['last', 'max', 'mean'])
+    def metric_chart(self, msg: Message, metrics, reduce=None, group_by=None, top=None, rank_by='last'):
+        """ Charts metrics or bookmarks of metrics, overlaid in one chart.
+
+        e.g. !metric chart 0 3 5
+        or !metric chart compute.googleapis.com/instance/cpu/utilization compute.googleapis.com/instance/uptime
+        The series can be reduced by the API, e.g. one line per zone instead of one per instance:
+        !metric chart compute.googleapis.com/instance/cpu/utilization --reduce mean --group-by zone
+        --group-by takes labels separated with commas, bare names are resource labels. It reduces with mean by default.
+        Only the top series are drawn, by last value unless --by max or --by mean, the others as a band:
+        !metric chart compute.googleapis.com/instance/cpu/utilization --top 5 --by max
+        With GOOGLE_MONITORING_PRERENDER_SECONDS set, a single bookmark is answered at once with its last
+        pre-rendered chart.
         """
-        try:
-            metric_type = self['bookmarks'][int(args)]
-        except ValueError:
-            metric_type = args.strip()
-
-        res = self.monitoring.projects().metricDescriptors().list(name='projects/%s' % self.project(),
-                                                                  filter='metric.type = "%s"' % metric_type).execute()
-        metrics = res.get('metricDescriptors', [])
-
-        if not metrics:
-            return 'Could not find metric %s' % args
-
-        metric = metrics[0]
-
-        url = self.gen_graph(metric['type'], metric['type'])
-        now = datetime.now()
-        now = datetime(day=now.day,
-                       month=now.month,
-                       year=now.year,
-                       hour=now.hour,
-                       minute=now.minute,
-                       second=now.second)
-        self.send_card(in_reply_to=msg,
-                       title=metric['description'],
-                       image=url,
-                       fields=(('Project', self.project()),
-                               ('Metric', metric),
-                               ('From', str(now - timedelta(minutes=15))),
-                               ('To', str(now)),
-                               ))
+        metric_types = []
+        for arg in metrics:
+            try:
+                metric_types.append(self['bookmarks'][int(arg)])
+            except ValueError:
+                metric_types.append(arg)
+            except IndexError:
+                return 'No bookmark %s, see !metric bookmarks' % arg
+
+        if self.prerenderer and len(metric_types) == 1 and not (reduce or group_by or top or rank_by != 'last'):
+            prerendered = self.prerendered.get((self.project(), metric_types[0]))
+            # Older than two periods, the scheduler is late: charts it now instead.
+            if prerendered and time.monotonic() - prerendered[3] < 2 * self.prerender_seconds:
+                metric, url, rendered_at, rendered_at_monotonic = prerendered
+                self._send_chart([metric], url, rendered_at,
+                                 [('Project', self.project()), ('Metric', metric['type']),
+                                  ('Rendered', '%is ago' % (time.monotonic() - rendered_at_monotonic))],
+                                 in_reply_to=msg)
+                return
+
+        group_by_fields = [_group_by_field(name) for name in group_by.split(',')] if group_by else None
+        if group_by_fields and not reduce:
+            reduce = 'mean'
+        cross_series_reducer = timeseries.CrossSeriesReducers[reduce.upper()].value if reduce else None
+
+        found = []
+        for metric_type, metric in zip(metric_types, self.descriptors().get_many(metric_types)):
+            if not metric:
+                return 'Could not find metric %s' % metric_type
+            if metric not in found:
+                found.append(metric)
+
+        self.send_chart_card(found, in_reply_to=msg,
+                             cross_series_reducer=cross_series_reducer, group_by_fields=group_by_fields,
+                             top=top, rank_by=rank_by)
 
     # Stackdriver webhooks integration.
     #
@@ -217,45 +436,126 @@ class GoogleCloudMonitoring(BotPlugin):
         self.log.debug("Incoming webhook:\n")
         whpp = pprint.pformat(req, indent=2)
         self.log.debug(whpp)
-        if 'dashboard' not in req:
-            self.log.warn('Unsupported webhook:\n' + whpp)
-            return 'ERROR'
-
-        dashboard = req['dashboard']
-        if 'root' not in dashboard:
+        try:
+            root = req['dashboard']['root']
+            # The dataSets are either in an xyChart or straight in the root.
+            data_sets = root.get('xyChart', root)['dataSets']
+            time_series_filters = tuple(data_set['timeSeriesFilter'] for data_set in data_sets)
+            # Identifies the chart, to merge its repeated requests.
+            key = tuple(json.dumps(time_series_filter, sort_keys=True) for time_series_filter in time_series_filters)
+            if not all(time_series_filter['filter'] for time_series_filter in time_series_filters):
+                time_series_filters = ()
+        except (KeyError, TypeError, AttributeError):
+            time_series_filters = ()
+        if not time_series_filters:
             self.log.warn('Unsupported webhook:\n' + whpp)
             return 'ERROR'
 
-        root = dashboard['root']
-        filter = root['dataSets'][0]['timeSeriesFilter']['filter']
-
-        res = self.monitoring.projects().metricDescriptors().list(name='projects/%s' % self.project(),
-                                                                  filter=filter).execute()
-        metrics = res.get('metricDescriptors', [])
-
-        if not metrics:
-            self.log.warn('Could not find metric form filter: %s', filter)
-            return 'ERROR'
+        # Charted on a worker, and only once more per window however many times Stackdriver repeats it.
+        try:
+            self.dashboard_jobs.submit(key, time_series_filters)
+        except queue.Full:
+            self.log.warn('Too many dashboard charts pending, dropped: %s', key)
+            return 'BUSY'
+        return "OK"
 
-        metric = metrics[0]
+    def post_dashboard_chart(self, time_series_filters):
+        """Posts a single chart of all the dataSets of a dashboard chart.
 
-        url = self.gen_graph(metric['type'], metric['type'])
-        now = datetime.now()
+        Each dataSet is fetched with its own filter and aggregation, so that two
+        dataSets of the same metric, e.g. of two zones, are drawn apart.
+        """
+        from charts import line
+        metrics = []
+        data_sets = []
+        for time_series_filter in time_series_filters:
+            filter = time_series_filter['filter']
+            metric = self.find_descriptor(filter)
+            if not metric:
+                self.log.warn('Could not find metric form filter: %s', filter)
+                continue
+            if metric not in metrics:
+                metrics.append(metric)
+            data_sets.append(line.DataSet.from_time_series_filter(_data_set_label(filter, metric['type']),
+                                                                  metric['type'], time_series_filter))
+        if data_sets:
+            room = self.query_room('google')  # TODO: pass on the Room from the message
+            types = [metric['type'] for metric in metrics]
+            url = self.gen_data_sets_graph(data_sets, '+'.join(types))
+            fields = [('Project', self.project()), ('Metric', ', '.join(types))]
+            if len(data_sets) > len(metrics):
+                fields.append(('Data sets', ', '.join(data_set.label for data_set in data_sets)))
+            self._send_chart(metrics, url, datetime.now(), fields, to=room)
+
+    def send_chart_card(self, metrics, cross_series_reducer=None, group_by_fields=None, top=None, rank_by='last',
+                        **target):
+        """Sends a card with a single chart of the last 15 minutes of the given metrics.
+
+        Args:
+          metrics: (list of dict) The metric descriptors.
+          cross_series_reducer: (Optional str) See gen_graph.
+          group_by_fields: (Optional list of str) See gen_graph.
+          top: (Optional int) See gen_graph.
+          rank_by: (Optional str) See gen_graph.
+          target: The recipient of the card: to= or in_reply_to=.
+        """
+        types = [metric['type'] for metric in metrics]
+        url = self.gen_graph(types, '+'.join(types), cross_series_reducer, group_by_fields, top, rank_by)
+        fields = [('Project', self.project()), ('Metric', ', '.join(types))]
+        if cross_series_reducer:
+            reduced = cross_series_reducer
+            if group_by_fields:
+                reduced += ' by ' + ', '.join(group_by_fields)
+            fields.append(('Reduced', reduced))
+        self._send_chart(metrics, url, datetime.now(), fields, **target)
+
+    def _send_chart(self, metrics, url, rendered_at, fields, **target):
+        now = rendered_at
         now = datetime(day=now.day,
                        month=now.month,
                        year=now.year,
                        hour=now.hour,
                        minute=now.minute,
                        second=now.second)
+        fields.append(('From', str(now - timedelta(minutes=15))))
+        fields.append(('To', str(now)))
+        self.send_card(title='; '.join(metric['description'] for metric in metrics),
+                       image=url,
+                       fields=tuple(fields),
+                       **target)
 
-        room = self.query_room('google')  # TODO: pass on the Room from the message
+    # Stackdriver incident notifications.
+    #
+    # Add a webhook notification to your alerting policies, e.g.:
+    # Endpoint URL: http://104.154.88.45:3141/alert
+    #
+    # The incidents are indexed as they come and posted as a periodic digest,
+    # see tools/client/post_alert.py for an example.
+    @webhook
+    def alert(self, req):
+        try:
+            self.incidents.apply(req['incident'])
+        except (KeyError, TypeError, AttributeError, ValueError):
+            self.log.warn('Unsupported incident:\n' + pprint.pformat(req, indent=2))
+            return 'ERROR'
+        return 'OK'
 
+    def post_incidents_digest(self):
+        digest = self.incidents.digest()
+        if not digest:
+            return
+
+        changes = [('Opened', incident) for incident in digest.opened] + \
+                  [('Closed', incident) for incident in digest.closed]
+        lines = ['%s: %s on %s - %s' % (change, incident['policy_name'], incident['resource_name'],
+                                        incident['summary'] or incident['condition_name'])
+                 for change, incident in changes[:INCIDENTS_DIGEST_MAX_LINES]]
+        if len(changes) > INCIDENTS_DIGEST_MAX_LINES:
+            lines.append('... and %i more.' % (len(changes) - INCIDENTS_DIGEST_MAX_LINES))
+
+        room = self.query_room(self.incidents_room)
         self.send_card(to=room,
-                       title=metric['description'],
-                       image=url,
-                       fields=(('Project', self.project()),
-                               ('Metric', metric),
-                               ('From', str(now - timedelta(minutes=15))),
-                               ('To', str(now)),
-                               ))
-        return "OK"
+                       title='%i incidents opened, %i closed' % (len(digest.opened), len(digest.closed)),
+                       body='\n'.join(lines),
+                       color='red' if digest.open_count else 'green',
+                       fields=(('Open incidents', str(digest.open_count)),))
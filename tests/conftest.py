@@ -0,0 +1,5 @@
+import sys
+from os import path
+
+# Makes the plugin modules (charts, gcloudutils...) importable from the tests.
+sys.path.insert(0, path.join(path.dirname(path.realpath(__file__)), '..'))
@@ -0,0 +1,103 @@
+import threading
+import time
+from concurrent import futures
+
+import bqresults
+
+
+class FakeJobs(object):
+    """Serves the rows of a job in pages of up to maxResults, like getQueryResults."""
+
+    def __init__(self, nb_rows, max_page_rows=None, latency=0):
+        self.rows = [{'f': [{'v': str(i)}]} for i in range(nb_rows)]
+        self.max_page_rows = max_page_rows
+        self.latency = latency
+        self.calls = []
+        self.running = self.max_running = 0
+        self.lock = threading.Lock()
+
+    def page(self, start, max_results):
+        end = min(start + max_results, len(self.rows))
+        page = {'jobReference': {'jobId': 'job'}, 'rows': self.rows[start:end], 'totalRows': str(len(self.rows))}
+        if end < len(self.rows):
+            page['pageToken'] = str(end)
+        return page
+
+    def getQueryResults(self, projectId, jobId, maxResults, pageToken=None, startIndex=None):
+        self.calls.append(maxResults)
+        start = int(pageToken) if pageToken else startIndex
+        page = self.page(start, min(maxResults, self.max_page_rows or maxResults))
+        jobs = self
+
+        class Request(object):
+            def execute(self):
+                with jobs.lock:
+                    jobs.running += 1
+                    jobs.max_running = max(jobs.max_running, jobs.running)
+                time.sleep(jobs.latency)
+                with jobs.lock:
+                    jobs.running -= 1
+                return page
+        return Request()
+
+
+def test_iter_pages_fetches_only_the_rows_yielded():
+    jobs = FakeJobs(10000)
+    pages = list(bqresults.iter_pages(jobs, 'project', jobs.page(0, 10), max_rows=120, page_rows=50))
+    assert [len(rows) for rows in pages] == [10, 50, 50, 10]
+    assert [row['f'][0]['v'] for rows in pages for row in rows] == [str(i) for i in range(120)]
+    assert jobs.calls == [50, 50, 10]
+
+
+def test_iter_pages_stops_at_the_last_page():
+    jobs = FakeJobs(15)
+    pages = list(bqresults.iter_pages(jobs, 'project', jobs.page(0, 10), max_rows=100))
+    assert [len(rows) for rows in pages] == [10, 5]
+
+
+def _decode(rows):
+    return [int(row['f'][0]['v']) for row in rows]
+
+
+def test_read_pages_fetches_the_pages_concurrently_in_order():
+    jobs = FakeJobs(1000, latency=0.05)
+    start = time.monotonic()
+    with futures.ThreadPoolExecutor(max_workers=9) as executor:
+        pages = bqresults.read_pages(jobs, 'project', jobs.page(0, 100), _decode,
+                                     page_rows=100, executor=executor)
+    assert time.monotonic() - start < 0.3
+    assert [value for page in pages for value in page] == list(range(1000))
+    assert len(jobs.calls) == 9 and jobs.max_running > 1
+
+
+def test_read_pages_completes_the_truncated_pages():
+    jobs = FakeJobs(1000, max_page_rows=30)
+    pages = bqresults.read_pages(jobs, 'project', jobs.page(0, 30), _decode, page_rows=100)
+    assert [value for page in pages for value in page] == list(range(1000))
+
+
+def test_normalize_query_ignores_whitespace_and_semicolon():
+    assert bqresults.normalize_query('SELECT a\n  FROM t;\n') == bqresults.normalize_query(' SELECT a FROM t')
+    assert bqresults.normalize_query("SELECT 'A'") != bqresults.normalize_query("SELECT 'a'")
+
+
+def test_normalize_query_keeps_the_whitespace_of_literals_and_comments():
+    assert bqresults.normalize_query("SELECT 'a  b'") != bqresults.normalize_query("SELECT 'a b'")
+    assert bqresults.normalize_query('SELECT "a\tb"') != bqresults.normalize_query('SELECT "a b"')
+    assert bqresults.normalize_query("SELECT  'it\\'s  ok'  FROM t") == "SELECT 'it\\'s  ok' FROM t"
+    # The end of a line comment still ends it.
+    assert bqresults.normalize_query('SELECT a -- all\n  FROM t') == 'SELECT a -- all\n FROM t'
+    assert bqresults.normalize_query('SELECT a -- all FROM t') != bqresults.normalize_query('SELECT a -- all\nFROM t')
+
+
+def test_format_cost():
+    assert bqresults.format_cost({'totalBytesProcessed': '0', 'cacheHit': True}) == \
+        '0 B processed, BigQuery cache hit.'
+    assert bqresults.format_cost({'totalBytesProcessed': str(5 * 1024 ** 3)}, cached_age=12.5) == \
+        '5.0 GB processed, from the local cache (12s old, --fresh to rerun).'
+
+
+def test_response_size_grows_with_the_rows():
+    small = FakeJobs(10).page(0, 10)
+    large = FakeJobs(10000).page(0, 10000)
+    assert bqresults.response_size(large) > 500 * bqresults.response_size(small)
@@ -0,0 +1,145 @@
+import gc
+import os
+import pickle
+import subprocess
+import sys
+import tracemalloc
+from datetime import datetime, timedelta
+
+import numpy as np
+from matplotlib.figure import Figure
+
+import charts
+from charts import downsample, interval, render, select
+from charts.line import Collection, Line
+
+START = datetime(2016, 1, 1)
+
+
+def test_lttb_keeps_bounds_and_spikes():
+    xs = np.array([START + timedelta(seconds=s) for s in range(10000)], dtype='datetime64[ns]')
+    ys = np.zeros(10000)
+    ys[1234] = 100.0
+    ys[8765] = -50.0
+
+    sampled_xs, sampled_ys = downsample.lttb(xs, ys, 960)
+    assert len(sampled_xs) == len(sampled_ys) == 960
+    assert sampled_xs[0] == xs[0] and sampled_xs[-1] == xs[-1]
+    assert (np.diff(sampled_xs) > np.timedelta64(0)).all()
+    assert 100.0 in sampled_ys and -50.0 in sampled_ys
+
+
+def test_lttb_leaves_short_lines_untouched():
+    xs, ys = np.arange(10), np.arange(10)
+    sampled_xs, sampled_ys = downsample.lttb(xs, ys, 960)
+    assert sampled_xs is xs and sampled_ys is ys
+
+
+def test_collection_survives_render_serialization():
+    xs = [START + timedelta(minutes=m) for m in range(5)]
+    collection = Collection([Line('vm1', xs, range(5)), Line('vm2', xs, range(5, 10))], 'm', START, xs[-1])
+    unpacked = render.unpack_collection(pickle.loads(pickle.dumps(render.pack_collection(collection))))
+    assert (unpacked.title, unpacked.start, unpacked.end) == (collection.title, collection.start, collection.end)
+    for original, copy in zip(collection, unpacked):
+        assert original.label == copy.label
+        assert (original.xs == copy.xs).all() and (original.ys == copy.ys).all()
+
+
+def test_renders_do_not_leak():
+    """Memory stays flat across renders, see tools/benchmarks/render_memory.py for 10k renders."""
+    xs = [START + timedelta(minutes=m) for m in range(15)]
+    collection = Collection([Line('vm%d' % i, xs, range(15)) for i in range(5)], 'm', xs[0], xs[-1])
+    tid = interval.guess(xs[0], xs[-1])
+
+    tracemalloc.start()
+    for _ in range(5):
+        charts.generate_timeseries_linechart(collection=collection, time_interval_display=tid)
+    gc.collect()
+    before = tracemalloc.take_snapshot()
+    for _ in range(20):
+        png = charts.generate_timeseries_linechart(collection=collection, time_interval_display=tid)
+    # The last PNG is still referenced, it is not part of the growth.
+    assert png.startswith(b'\x89PNG')
+    del png
+    gc.collect()
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+
+    growth = sum(stat.size_diff for stat in after.compare_to(before, 'filename'))
+    assert growth < 64 * 1024
+    assert not [o for o in gc.get_objects() if isinstance(o, Figure) and o is not charts._TEMPLATE.figure]
+
+
+def test_chart_digest_depends_only_on_the_content():
+    xs = [START + timedelta(minutes=m) for m in range(5)]
+    tid = interval.guess(xs[0], xs[-1])
+
+    def digest(ys, **kwargs):
+        return render.chart_digest(collection=Collection([Line('vm1', xs, ys)], 'm', xs[0], xs[-1]),
+                                   time_interval_display=tid, **kwargs)
+
+    assert digest(range(5)) == digest(range(5))
+    assert digest(range(5)) != digest(range(1, 6))
+    assert digest(range(5)) != digest(range(5), y_formatter=charts._format_percent)
+    assert render.chart_digest(title='t', values=[1]) != render.chart_digest(title='t', values=[2])
+
+
+def test_importing_charts_does_not_import_the_plotting_stack():
+    code = ('import sys; import charts.render, charts.cache, charts.descriptors, charts.interval; '
+            'print([m for m in ("matplotlib", "numpy", "googleapiclient") if m in sys.modules])')
+    root = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..')
+    out = subprocess.check_output([sys.executable, '-c', code], cwd=root)
+    assert out.decode('utf-8').strip() == '[]'
+
+
+def test_top_k_keeps_the_highest_lines_and_folds_the_others():
+    xs = [START + timedelta(minutes=m) for m in range(5)]
+    lines = [Line('vm%d' % i, xs, [i, i, i, i, 100 - i]) for i in range(50)]
+    collection = Collection(lines, 'm', xs[0], xs[-1])
+
+    by_last = select.top_k(collection, 3)
+    assert [line.label for line in by_last] == ['vm0', 'vm1', 'vm2']
+    by_mean = select.top_k(collection, 3, by='mean')
+    assert [line.label for line in by_mean] == ['vm49', 'vm48', 'vm47']
+
+    band = by_last.band
+    assert band.label == 'others (47)'
+    assert band.lows.tolist() == [3, 3, 3, 3, 51]
+    assert band.highs.tolist() == [49, 49, 49, 49, 97]
+
+    unpacked = render.unpack_collection(pickle.loads(pickle.dumps(render.pack_collection(by_last))))
+    assert (unpacked.band.highs == band.highs).all() and unpacked.band.count == 47
+    assert render.chart_digest(by_last) != render.chart_digest(select.top_k(collection, 4))
+
+
+def test_top_k_counts_the_lines_folded_earlier():
+    xs = [START + timedelta(minutes=m) for m in range(5)]
+    collection = Collection([Line('vm%d' % i, xs, [i] * 5) for i in range(100)], 'm', xs[0], xs[-1])
+    twice = select.top_k(select.top_k(collection, 50), 20)
+    assert len(twice) == 20
+    assert twice.band.count == 80 and twice.band.label == 'others (80)'
+    assert twice.band.lows.tolist() == [0] * 5 and twice.band.highs.tolist() == [79] * 5
+
+
+def test_wide_charts_are_bounded():
+    xs = [START + timedelta(minutes=m) for m in range(15)]
+    tid = interval.guess(xs[0], xs[-1])
+    charts.generate_timeseries_linechart(collection=Collection([Line('vm0', xs, range(15))], 'm', xs[0], xs[-1]),
+                                         time_interval_display=tid)
+    small = charts._TEMPLATE.figure.get_size_inches().tolist()
+    wide = Collection([Line('vm%d' % i, xs, range(i, i + 15)) for i in range(500)], 'm', xs[0], xs[-1])
+    png = charts.generate_timeseries_linechart(collection=wide, time_interval_display=tid, max_lines=5)
+    assert png.startswith(b'\x89PNG')
+    assert charts._TEMPLATE.figure.get_size_inches().tolist() == small
+
+
+def test_render_pool_survives_a_dead_renderer():
+    pool = render.RenderPool(1)
+    try:
+        assert pool.render_barchart(title='t', ylabel='', labels=['a'], values=[1]).startswith(b'\x89PNG')
+        for process in list(pool._executor._processes.values()):
+            process.terminate()
+            process.join()
+        assert pool.render_barchart(title='t', ylabel='', labels=['a'], values=[2]).startswith(b'\x89PNG')
+    finally:
+        pool.close()
@@ -0,0 +1,71 @@
+from charts import descriptors
+
+DESCRIPTORS = [
+    {'type': 'compute.googleapis.com/instance/cpu/utilization', 'description': 'CPU utilization'},
+    {'type': 'compute.googleapis.com/instance/disk/read_bytes_count', 'description': 'Disk read bytes'},
+    {'type': 'custom.googleapis.com/queue/depth', 'description': 'Depth of the work queue'},
+]
+
+
+class FakeRequest(object):
+    def __init__(self, response):
+        self._response = response
+
+    def execute(self):
+        return self._response
+
+
+class FakeMonitoringAPI(object):
+    """Serves the descriptors one per page."""
+
+    def __init__(self, new_descriptors=()):
+        self.calls = 0
+        self.filters = []
+        # Created after the index is loaded, only found by a filter.
+        self.new_descriptors = list(new_descriptors)
+
+    def projects(self):
+        return self
+
+    def metricDescriptors(self):
+        return self
+
+    def list(self, name, filter=None, pageToken=None, fields=None):
+        self.calls += 1
+        if filter:
+            self.filters.append(filter)
+            return FakeRequest({'metricDescriptors': [d for d in self.new_descriptors
+                                                      if '"%s"' % d['type'] in filter]})
+        i = int(pageToken or 0)
+        response = {'metricDescriptors': DESCRIPTORS[i:i + 1]}
+        if i + 1 < len(DESCRIPTORS):
+            response['nextPageToken'] = str(i + 1)
+        return FakeRequest(response)
+
+
+def test_index_is_loaded_once_and_searchable():
+    api = FakeMonitoringAPI()
+    index = descriptors.DescriptorIndex(api, 'p')
+
+    assert index.get('custom.googleapis.com/queue/depth')['description'] == 'Depth of the work queue'
+    assert [d['type'] for d in index.find_by_prefix('compute.')] == [d['type'] for d in DESCRIPTORS[:2]]
+    assert [d['type'] for d in index.find_by_substring('DISK')] == [DESCRIPTORS[1]['type']]
+    assert [d['type'] for d in index.find_by_tokens('queue depth')] == [DESCRIPTORS[2]['type']]
+    assert len(index.search('cpu')) == 1
+    assert len(index.search()) == 3
+    assert api.calls == len(DESCRIPTORS)
+
+
+def test_get_many_fetches_the_unknown_types_in_one_call():
+    new = [{'type': 'custom.googleapis.com/a', 'description': 'A'},
+           {'type': 'custom.googleapis.com/b', 'description': 'B'}]
+    api = FakeMonitoringAPI(new)
+    index = descriptors.DescriptorIndex(api, 'p')
+    index.load()
+
+    found = index.get_many(['custom.googleapis.com/b', DESCRIPTORS[0]['type'],
+                            'custom.googleapis.com/a', 'custom.googleapis.com/nope'])
+    assert [d and d['description'] for d in found] == ['B', 'CPU utilization', 'A', None]
+    assert len(api.filters) == 1
+    assert index.get('custom.googleapis.com/a') is not None
+    assert len(api.filters) == 1
@@ -0,0 +1,48 @@
+import threading
+
+import gcloudhttp
+
+
+class FakeCredentials(object):
+    def authorize(self, http):
+        return http
+
+
+def test_each_thread_gets_its_own_http():
+    transport = gcloudhttp.Transport(FakeCredentials())
+    assert transport.http() is transport.http()
+
+    others = []
+    thread = threading.Thread(target=lambda: others.append(transport.http()))
+    thread.start()
+    thread.join()
+    assert others[0] is not transport.http()
+
+
+def test_requests_use_the_http_of_their_thread():
+    transport = gcloudhttp.Transport(FakeCredentials())
+    request = transport._request_builder(object(), None, 'https://example.com', method='GET')
+    assert request.http is transport.http()
+
+
+def test_gzip_is_requested(monkeypatch):
+    sent = {}
+
+    def fake_request(self, uri, method='GET', body=None, headers=None, *args, **kwargs):
+        sent.update(headers)
+
+    monkeypatch.setattr(gcloudhttp.httplib2.Http, 'request', fake_request)
+    gcloudhttp._GzipHttp().request('https://example.com', headers={'user-agent': 'errbot'})
+    assert sent == {'accept-encoding': 'gzip', 'user-agent': 'errbot (gzip)'}
+
+
+def test_discovery_documents_are_read_from_disk_once(tmpdir, monkeypatch):
+    monkeypatch.setattr(gcloudhttp, '_DOCUMENTS', {})
+    tmpdir.join('fakeapi.v1.json').write('{"name": "fakeapi"}')
+    cache = gcloudhttp.DiscoveryCache(str(tmpdir))
+
+    # No http: the document must not be fetched.
+    document = cache.get('fakeapi', 'v1', http=None)
+    assert document == {'name': 'fakeapi'}
+    tmpdir.join('fakeapi.v1.json').remove()
+    assert gcloudhttp.DiscoveryCache().get('fakeapi', 'v1', http=None) is document
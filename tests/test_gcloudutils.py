@@ -0,0 +1,109 @@
+import threading
+import time
+
+import gcloudutils
+
+
+def test_lru_cache_evicts_least_recently_used():
+    lru = gcloudutils.LRUCache(2)
+    lru.put('a', 1)
+    lru.put('b', 2)
+    assert lru.get('a') == 1
+    lru.put('c', 3)
+    assert 'b' not in lru
+    assert lru.get('a') == 1 and lru.get('c') == 3
+
+
+def test_lru_cache_expires_entries():
+    lru = gcloudutils.LRUCache(2, ttl=0.01)
+    lru.put('a', 1)
+    time.sleep(0.02)
+    assert lru.get('a') is None
+    assert len(lru) == 0
+
+
+def _wait_for(done, count):
+    deadline = time.monotonic() + 5
+    while len(done) < count and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+
+def test_coalescing_queue_merges_duplicates_within_the_window():
+    done = []
+    jobs = gcloudutils.CoalescingQueue(done.append, workers=2, window=0.2)
+    assert jobs.submit('a', 1)
+    _wait_for(done, 1)
+    # The repeats within the window run once, at its end, with the last payload.
+    assert jobs.submit('a', 2)
+    for payload in range(3, 10):
+        assert not jobs.submit('a', payload)
+    assert jobs.submit('b', 'x')
+    _wait_for(done, 3)
+    jobs.close()
+    assert sorted(done, key=str) == [1, 9, 'x']
+    assert done.index(9) == 2
+    assert len(jobs) == 0
+
+
+def test_coalescing_queue_runs_the_first_job_right_away():
+    done = []
+    jobs = gcloudutils.CoalescingQueue(done.append, window=60)
+    started = time.monotonic()
+    jobs.submit('a', 1)
+    _wait_for(done, 1)
+    jobs.close()
+    assert done == [1]
+    assert time.monotonic() - started < 1
+
+
+def test_refresh_scheduler_refreshes_every_key_with_bounded_concurrency():
+    lock = threading.Lock()
+    refreshed, running, most_running = [], [], [0]
+
+    def refresh(key):
+        with lock:
+            running.append(key)
+            most_running[0] = max(most_running[0], len(running))
+        time.sleep(0.01)
+        with lock:
+            running.remove(key)
+            refreshed.append(key)
+
+    scheduler = gcloudutils.RefreshScheduler(refresh, lambda: ['a', 'b', 'c', 'd'], period=0.2, workers=2)
+    time.sleep(0.9)
+    scheduler.close()
+    assert set(refreshed) == {'a', 'b', 'c', 'd'}
+    assert most_running[0] <= 2
+    # Refreshed once per period, not continuously.
+    assert refreshed.count('a') <= 6
+
+
+def test_refresh_scheduler_sleeps_until_a_refresh_is_due():
+    listed, keys = [], ['a']
+
+    def list_keys():
+        listed.append(list(keys))
+        return keys
+
+    scheduler = gcloudutils.RefreshScheduler(lambda key: None, list_keys, period=3600)
+    time.sleep(0.3)
+    assert len(listed) == 1
+    keys.append('b')
+    scheduler.wake()
+    _wait_for(listed, 2)
+    scheduler.close()
+    assert listed == [['a'], ['a', 'b']]
+
+
+def test_lru_cache_keeps_within_its_memory_budget():
+    lru = gcloudutils.LRUCache(10, max_bytes=10, sizeof=len)
+    lru.put('a', 'aaaa')
+    lru.put('b', 'bbbb')
+    lru.put('c', 'cccc')
+    assert 'a' not in lru and lru.get('b') == 'bbbb' and lru.get('c') == 'cccc'
+    # Too big for the whole budget: not kept, and nothing else is evicted for it.
+    lru.put('d', 'd' * 11)
+    assert 'd' not in lru and len(lru) == 2
+    assert lru.pop('b') == 'bbbb'
+    lru.put('e', 'eeeeee')
+    assert lru.get('c') == 'cccc' and lru.get('e') == 'eeeeee'
@@ -0,0 +1,56 @@
+import threading
+import time
+
+import incidents
+
+
+def _incident(incident_id, state):
+    return {'incident_id': incident_id, 'state': state, 'policy_name': 'Webserver Health',
+            'resource_name': 'www1', 'summary': 'CPU usage is above the threshold'}
+
+
+def test_transitions_are_idempotent():
+    index = incidents.IncidentIndex()
+    assert index.apply(_incident('a', 'open'))
+    assert not index.apply(_incident('a', 'open'))
+    assert index.apply(_incident('a', 'closed'))
+    assert not index.apply(_incident('a', 'closed'))
+    # A late retry of the opening doesn't reopen it.
+    assert not index.apply(_incident('a', 'open'))
+    assert index.get('a')['state'] == 'closed'
+    assert index.open_incidents() == []
+
+
+def test_digest_reports_the_changes_once():
+    index = incidents.IncidentIndex(retention=0)
+    index.apply(_incident('a', 'open'))
+    index.apply(_incident('b', 'open'))
+    index.apply(_incident('b', 'closed'))
+    digest = index.digest()
+    assert [i['incident_id'] for i in digest.opened] == ['a']
+    assert [i['incident_id'] for i in digest.closed] == ['b']
+    assert digest.open_count == 1
+    assert not index.digest()
+    # Closed incidents are forgotten past their retention.
+    assert len(index) == 1
+
+
+def test_handles_thousands_of_incidents_from_many_threads():
+    index = incidents.IncidentIndex()
+
+    def post(thread):
+        for i in range(2500):
+            incident_id = '%d-%d' % (thread, i)
+            for state in ('open', 'open', 'closed'):
+                index.apply(_incident(incident_id, state))
+
+    threads = [threading.Thread(target=post, args=(t,)) for t in range(8)]
+    start = time.monotonic()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert time.monotonic() - start < 5
+
+    digest = index.digest()
+    assert len(digest.closed) == 20000 and not digest.opened and digest.open_count == 0
@@ -0,0 +1,109 @@
+from concurrent import futures
+from datetime import datetime, timedelta
+
+import numpy as np
+
+from charts import line
+from charts.line import Collection, Line
+
+START = datetime(2016, 1, 1)
+XS = [START + timedelta(minutes=m) for m in range(5)]
+
+
+def test_line_is_columnar():
+    line = Line('vm1', XS, [1, 2, 3, 4, 5])
+    assert line.xs.dtype == np.dtype('datetime64[ns]')
+    assert line.ys.dtype == np.float64
+    assert not hasattr(line, '__dict__')
+
+
+def test_collection_bounds_and_aligned_matrix():
+    collection = Collection([Line('vm1', XS, range(5)), Line('vm2', XS, range(5, 10))], 'm', START, XS[-1])
+    assert collection.min == XS[0]
+    assert collection.max == XS[-1]
+    xs, ys = collection.aligned()
+    assert len(xs) == 5
+    assert ys.shape == (2, 5)
+
+    unaligned = Collection([Line('vm1', XS, range(5)), Line('vm2', XS[1:], range(4))], 'm', START, XS[-1])
+    assert unaligned.aligned() is None
+
+
+def _point(dt, value):
+    return {'interval': {'endTime': dt.strftime('%Y-%m-%dT%H:%M:%S.%fZ')}, 'value': value}
+
+
+def test_decode_points_sorts_and_masks():
+    points = [_point(XS[i], {'int64Value': str(i)}) for i in (3, 0, 4, 1, 2)]
+    xs, ys = line._decode_points(points, XS[1], XS[3])
+    assert [line.to_datetime(x) for x in xs] == XS[1:4]
+    assert list(ys) == [1.0, 2.0, 3.0]
+
+
+def test_decode_points_newest_first():
+    points = [_point(XS[i], {'doubleValue': i / 2}) for i in reversed(range(5))]
+    xs, ys = line._decode_points(points, XS[0], XS[-1])
+    assert [line.to_datetime(x) for x in xs] == XS
+    assert list(ys) == [0, 0.5, 1, 1.5, 2]
+
+
+def test_many_metrics_are_merged_into_one_collection():
+    from test_timeseries import FakeMonitoringAPI
+    from charts import interval, timeseries
+
+    end = START + timedelta(minutes=10)
+    tid = interval.guess(START, end)
+    api = timeseries.Client(FakeMonitoringAPI())
+    with futures.ThreadPoolExecutor(max_workers=2) as executor:
+        collection = line.get_collection_from_many_metrics(
+            api, 'p', ['compute.googleapis.com/instance/cpu/utilization',
+                       'compute.googleapis.com/instance/disk/read_ops_count'], START, end, tid, executor=executor)
+    assert [current.label for current in collection] == ['cpu/utilization vm1', 'cpu/utilization vm2',
+                                                         'disk/read_ops_count vm1', 'disk/read_ops_count vm2']
+    assert collection.title == 'cpu/utilization, disk/read_ops_count'
+
+
+def test_a_single_metric_is_fetched_on_the_calling_thread():
+    from test_timeseries import FakeMonitoringAPI
+    from charts import interval, timeseries
+
+    class Unused(futures.Executor):
+        def submit(self, fn, *args, **kwargs):
+            raise AssertionError('a single metric is fetched by the executor')
+
+    end = START + timedelta(minutes=10)
+    collection = line.get_collection_from_many_metrics(
+        timeseries.Client(FakeMonitoringAPI()), 'p', ['compute.googleapis.com/instance/cpu/utilization'],
+        START, end, interval.guess(START, end), executor=Unused())
+    assert len(list(collection)) == 2
+
+
+def test_reduced_series_are_labeled_by_group():
+    api_series = {'metric': {'labels': {}}, 'resource': {'labels': {'zone': 'us-central1-c'}}}
+    assert line._get_series_label_reduced(api_series) == 'us-central1-c'
+    assert line._get_series_label_reduced({'metric': {}}) == 'all'
+
+
+def test_data_sets_of_a_metric_are_fetched_with_their_own_filter():
+    from test_timeseries import FakeMonitoringAPI
+    from charts import interval, timeseries
+
+    metric = 'compute.googleapis.com/instance/cpu/utilization'
+    end = START + timedelta(minutes=10)
+    tid = interval.guess(START, end)
+    tid.per_series_aligner = tid.alignment_period = None
+    fake = FakeMonitoringAPI()
+    data_sets = [
+        line.DataSet.from_time_series_filter('cpu/utilization zone=a', metric, {
+            'filter': 'metric.type="%s" AND resource.label.zone="a"' % metric}),
+        line.DataSet.from_time_series_filter('cpu/utilization zone=b', metric, {
+            'filter': 'metric.type="%s" AND resource.label.zone="b"' % metric,
+            'aggregation': {'perSeriesAligner': 'ALIGN_MEAN', 'alignmentPeriod': '60s'}}),
+    ]
+    collection = line.get_collection_from_data_sets(timeseries.Client(fake), 'p', data_sets, START, end, tid)
+
+    assert sorted(call['filter'] for call in fake.calls) == [data_set.filter for data_set in data_sets]
+    aligned = [call for call in fake.calls if 'zone="b"' in call['filter']][0]
+    assert aligned['aggregation_perSeriesAligner'] == 'ALIGN_MEAN'
+    assert [current.label for current in collection] == ['cpu/utilization zone=a vm1', 'cpu/utilization zone=a vm2',
+                                                         'cpu/utilization zone=b vm1', 'cpu/utilization zone=b vm2']
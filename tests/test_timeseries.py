@@ -0,0 +1,222 @@
+from datetime import datetime, timedelta
+
+from charts import cache, timeseries
+
+
+def _point(dt, value):
+    return {'interval': {'endTime': timeseries._RFC3339(dt)}, 'value': {'int64Value': str(value)}}
+
+
+class FakeRequest(object):
+    def __init__(self, response):
+        self._response = response
+
+    def execute(self, http=None):
+        return self._response
+
+
+class FakeMonitoringAPI(object):
+    """Serves one point per minute for two instances, one page per call.
+
+    With a clock, only the points written by now are served.
+    """
+
+    def __init__(self, now=None):
+        self.calls = []
+        self.now = now
+
+    def projects(self):
+        return self
+
+    def timeSeries(self):
+        return self
+
+    def list(self, **kwargs):
+        self.calls.append(kwargs)
+        start = timeseries._parse_RFC3339(kwargs['interval_startTime'])
+        end = timeseries._parse_RFC3339(kwargs['interval_endTime'])
+        written = end if self.now is None else min(end, self.now)
+        aligner = kwargs.get('aggregation_perSeriesAligner')
+        serieses = []
+        for name in ('vm1', 'vm2'):
+            points = []
+            if aligner and aligner != 'ALIGN_NONE':
+                # The aligned buckets are counted back from the end of the request.
+                period = timeseries._alignment_period_string_to_delta(kwargs['aggregation_alignmentPeriod'])
+                t = end
+                while t >= start:
+                    if t <= written:
+                        points.append(_point(t, t.minute))
+                    t -= period
+            else:
+                # On the minutes.
+                t = start + (datetime.min - start) % timedelta(minutes=1)
+                while t <= written:
+                    points.append(_point(t, t.minute))
+                    t += timedelta(minutes=1)
+            serieses.append({'metric': {'labels': {'instance_name': name}},
+                             'resource': {'labels': {'zone': 'us-central1-c'}},
+                             'points': points})
+        return FakeRequest({'timeSeries': serieses})
+
+
+class PagedMonitoringAPI(FakeMonitoringAPI):
+    """Serves each series in its own page."""
+
+    def list(self, **kwargs):
+        page = int(kwargs.get('pageToken', 0))
+        response = super().list(**kwargs)._response
+        serieses = response['timeSeries']
+        response = {'timeSeries': [serieses[page]]}
+        if page + 1 < len(serieses):
+            response['nextPageToken'] = str(page + 1)
+        return FakeRequest(response)
+
+
+def test_iter_timeseries_requests_the_pages_lazily():
+    start = datetime(2016, 1, 1, 0, 0)
+    api = PagedMonitoringAPI()
+    serieses = timeseries.Client(api).iter_timeseries('p', 'compute.googleapis.com/m', start,
+                                                      start + timedelta(minutes=15))
+    assert api.calls == []
+    assert next(serieses)['metric']['labels']['instance_name'] == 'vm1'
+    assert len(api.calls) == 1
+    assert next(serieses)['metric']['labels']['instance_name'] == 'vm2'
+    assert len(api.calls) == 2 and api.calls[-1]['pageToken'] == '1'
+    assert next(serieses, None) is None
+
+
+def test_split_interval_is_aligned_and_contiguous():
+    start = datetime(2016, 1, 1, 0, 0)
+    end = start + timedelta(minutes=10)
+    windows = timeseries._split_interval(start, end, timedelta(minutes=1), 4)
+    assert windows[0][0] == start
+    assert windows[-1][1] == end
+    for (_, prev_end), (next_start, _) in zip(windows, windows[1:]):
+        assert prev_end == next_start
+    for _, window_end in windows:
+        assert (end - window_end) % timedelta(minutes=1) == timedelta(0)
+
+
+def test_split_interval_counts_the_periods_back_from_the_end():
+    start = datetime(2016, 1, 1, 0, 0, 10)
+    end = start + timedelta(minutes=10, seconds=25)
+    windows = timeseries._split_interval(start, end, timedelta(minutes=1), 4)
+    assert windows[0][0] == start and windows[-1][1] == end
+    for window_start, window_end in windows[1:]:
+        assert (end - window_start) % timedelta(minutes=1) == timedelta(0)
+
+
+def test_sharded_list_timeseries_matches_sequential():
+    start = datetime(2016, 1, 1, 0, 0, 10)
+    end = start + timedelta(minutes=4 * timeseries.MIN_SHARD_BUCKETS, seconds=25)
+    api = FakeMonitoringAPI()
+    client = timeseries.Client(api)
+    sequential = client.list_timeseries('p', 'compute.googleapis.com/m', start, end)
+    sharded = client.list_timeseries('p', 'compute.googleapis.com/m', start, end, max_workers=4)
+
+    assert len(api.calls) == 1 + 4
+    assert len(sharded) == len(sequential) == 2
+    for seq, shard in zip(sequential, sharded):
+        assert seq['metric'] == shard['metric']
+        assert sorted(p['interval']['endTime'] for p in seq['points']) == \
+            sorted(p['interval']['endTime'] for p in shard['points'])
+
+
+def test_short_intervals_are_not_sharded():
+    start = datetime(2016, 1, 1, 0, 0)
+    api = FakeMonitoringAPI()
+    client = timeseries.Client(api)
+    client.list_timeseries('p', 'compute.googleapis.com/m', start, start + timedelta(minutes=30), max_workers=4)
+    assert len(api.calls) == 1
+
+
+def _end_times(serieses):
+    """The endTimes of raw series, or of the decoded ones from a CachingClient."""
+    return [sorted(timeseries._RFC3339(x.astype(datetime)) for x in series['columns'][0].astype('datetime64[us]'))
+            if 'columns' in series else sorted(p['interval']['endTime'] for p in series['points'])
+            for series in serieses]
+
+
+def test_caching_client_fetches_only_the_tail():
+    now = datetime(2016, 1, 1, 0, 30)
+    api = FakeMonitoringAPI(now=now)
+    client = cache.CachingClient(timeseries.Client(api), cache.TimeseriesCache())
+
+    def chart(**kwargs):
+        # Like gen_graph: the last 15 minutes, ending a minute from now.
+        end = api.now + timedelta(minutes=1)
+        return client.list_timeseries('p', 'compute.googleapis.com/m', end - timedelta(minutes=15), end, **kwargs)
+
+    first = chart(per_series_aligner=None, alignment_period=None, max_workers=4)
+    assert chart(per_series_aligner=None, alignment_period=None) == first
+    assert len(api.calls) == 1
+
+    # The points keep coming while the charts are refreshed.
+    for _ in range(5):
+        api.now += timedelta(seconds=30)
+        calls = len(api.calls)
+        cached = chart(per_series_aligner=None, alignment_period=None, max_workers=4)
+        assert len(api.calls) == calls + 1
+        # A single request for the tail, from a little before the newest cached point.
+        assert api.calls[-1]['interval_startTime'] >= timeseries._RFC3339(now - cache.LATE_POINTS_ALLOWANCE)
+        end = api.now + timedelta(minutes=1)
+        fetched = client._client.list_timeseries('p', 'compute.googleapis.com/m', end - timedelta(minutes=15), end,
+                                                 per_series_aligner=None, alignment_period=None)
+        assert _end_times(cached) == _end_times(fetched)
+
+
+def test_caching_client_refetches_the_last_aligned_bucket():
+    api = FakeMonitoringAPI(now=datetime(2016, 1, 1, 0, 30))
+    client = cache.CachingClient(timeseries.Client(api), cache.TimeseriesCache())
+    end = api.now + timedelta(minutes=1)
+    client.list_timeseries('p', 'compute.googleapis.com/m', end - timedelta(minutes=15), end)
+
+    api.now += timedelta(minutes=2)
+    end = api.now + timedelta(minutes=1)
+    cached = client.list_timeseries('p', 'compute.googleapis.com/m', end - timedelta(minutes=15), end)
+    assert api.calls[-1]['interval_startTime'] == timeseries._RFC3339(datetime(2016, 1, 1, 0, 28))
+    fetched = client._client.list_timeseries('p', 'compute.googleapis.com/m', end - timedelta(minutes=15), end)
+    assert _end_times(cached) == _end_times(fetched)
+
+
+def test_caching_client_aligns_the_tails_on_whole_periods():
+    api = FakeMonitoringAPI(now=datetime(2016, 1, 1, 0, 30))
+    client = cache.CachingClient(timeseries.Client(api), cache.TimeseriesCache())
+    for _ in range(3):
+        api.now += timedelta(seconds=30)
+        end = api.now + timedelta(minutes=1)
+        cached = client.list_timeseries('p', 'compute.googleapis.com/m', end - timedelta(minutes=15), end)
+
+    # The same buckets as a single request ending on the minute, without the :30 ones.
+    fetched = client._client.list_timeseries('p', 'compute.googleapis.com/m', end - timedelta(minutes=15),
+                                             end.replace(second=0))
+    assert _end_times(cached) == _end_times(fetched)
+    assert all(t.endswith(':00Z') for end_times in _end_times(cached) for t in end_times)
+
+
+def test_timeseries_cache_evicts_past_memory_budget():
+    lru = cache.TimeseriesCache(max_bytes=cache._SERIES_SIZE_BYTES + cache._POINT_SIZE_BYTES * 10)
+    for i in range(3):
+        entry = cache._Entry(datetime(2016, 1, 1), datetime(2016, 1, 2))
+        entry.merge([{'metric': {'labels': {'i': str(i)}},
+                      'points': [_point(datetime(2016, 1, 1, 0, m), m) for m in range(6)]}])
+        lru.put(i, entry)
+    assert len(lru) == 1
+    assert lru.get(2) is not None
+
+
+def test_cross_series_reduction_is_requested_and_cached_separately():
+    start = datetime(2016, 1, 1, 0, 0)
+    end = start + timedelta(minutes=5)
+    api = FakeMonitoringAPI()
+    client = cache.CachingClient(timeseries.Client(api), cache.TimeseriesCache())
+
+    client.list_timeseries('p', 'compute.googleapis.com/m', start, end)
+    client.list_timeseries('p', 'compute.googleapis.com/m', start, end,
+                           cross_series_reducer=timeseries.CrossSeriesReducers.MEAN.value,
+                           group_by_fields=['resource.label.zone'])
+    assert len(api.calls) == 2
+    assert api.calls[-1]['aggregation_crossSeriesReducer'] == 'REDUCE_MEAN'
+    assert api.calls[-1]['aggregation_groupByFields'] == ['resource.label.zone']
+    assert 'aggregation_crossSeriesReducer' not in api.calls[0]
@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+
+# Copyright 2015 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#    http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Compares the point by point and the batch timeseries point decoders."""
+
+import os
+import sys
+import timeit
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', '..'))
+
+from charts import line  # noqa
+
+
+def make_points(nb_points):
+    """Makes points the way the API returns them: newest first."""
+    end = datetime(2016, 1, 1)
+    return [{'interval': {'endTime': (end - timedelta(minutes=i)).strftime('%Y-%m-%dT%H:%M:%S.%fZ')},
+             'value': {'doubleValue': float(i)}}
+            for i in range(nb_points)]
+
+
+def decode_point_by_point(points, start, end):
+    points.sort(key=line._datetime_of_point)
+    xs, ys = [], []
+    for pt in points:
+        dt = line._datetime_of_point(pt)
+        if dt < start or dt > end:
+            continue
+        xs.append(dt)
+        ys.append(line._value_of_point(pt))
+    return xs, ys
+
+
+def main(nb_points=10000, repeat=5):
+    points = make_points(nb_points)
+    start, end = datetime(2015, 12, 25), datetime(2016, 1, 1)
+
+    def bench(decoder):
+        return min(timeit.repeat(lambda: decoder(list(points), start, end), number=1, repeat=repeat))
+
+    legacy = bench(decode_point_by_point)
+    batch = bench(line._decode_points)
+    print('%d points: point by point %.1fms, batch %.1fms, speedup x%.1f' % (
+        nb_points, legacy * 1000, batch * 1000, legacy / batch))
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
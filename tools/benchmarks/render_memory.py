@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+
+# Copyright 2015 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#    http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Renders many charts in a row and reports the resident memory growth."""
+
+import os
+import resource
+import sys
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', '..'))
+
+import charts  # noqa
+from charts import interval  # noqa
+from charts.line import Collection, Line  # noqa
+
+
+def rss_mb():
+    """The current resident set size, in MB (Linux only)."""
+    with open('/proc/self/statm') as statm:
+        return int(statm.read().split()[1]) * resource.getpagesize() / 1024 / 1024
+
+
+def make_collection(nb_lines=10, nb_points=15):
+    start = datetime(2016, 1, 1)
+    xs = [start + timedelta(minutes=m) for m in range(nb_points)]
+    lines = [Line('vm%d' % i, xs, [i * m for m in range(nb_points)]) for i in range(nb_lines)]
+    return Collection(lines=lines, title='compute.googleapis.com/instance/cpu/utilization', start=xs[0], end=xs[-1])
+
+
+def main(nb_renders=10000):
+    collection = make_collection()
+    tid = interval.guess(collection.start, collection.end)
+
+    charts.generate_timeseries_linechart(collection=collection, time_interval_display=tid)
+    baseline = rss_mb()
+    start_time = time.time()
+    report_every = max(1, nb_renders // 10)
+    for i in range(1, nb_renders + 1):
+        charts.generate_timeseries_linechart(collection=collection, time_interval_display=tid)
+        if i % report_every == 0:
+            print('%d renders: RSS %.1fMB (%+.1fMB), %.1fms per render' % (
+                i, rss_mb(), rss_mb() - baseline, (time.time() - start_time) * 1000 / i))
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
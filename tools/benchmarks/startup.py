@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+
+# Copyright 2015 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#    http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Reports how long the plugins and the charts modules take to import.
+
+Each module is imported in a fresh interpreter, like errbot does on a cold
+start, along with the heavy dependencies it pulled in.
+"""
+
+import json
+import os
+import subprocess
+import sys
+
+ROOT = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', '..')
+
+MODULES = ['gcloud', 'monitoring', 'bigquery', 'gce',
+           'charts', 'charts.render', 'charts.cache', 'charts.descriptors', 'charts.line']
+
+HEAVY_MODULES = ['matplotlib', 'numpy', 'googleapiclient', 'oauth2client', 'errbot']
+
+_PROBE = '''
+import json, sys, time
+sys.path.insert(0, %(root)r)
+start = time.perf_counter()
+try:
+    __import__(%(module)r)
+    error = None
+except ImportError as e:
+    error = str(e)
+print(json.dumps({'ms': (time.perf_counter() - start) * 1000, 'error': error,
+                  'heavy': [m for m in %(heavy)r if m in sys.modules]}))
+'''
+
+
+def measure(module, repeat=3):
+    """Returns the best import time of a module in ms, what it loaded and its import error."""
+    best = None
+    for _ in range(repeat):
+        probe = _PROBE % dict(root=ROOT, module=module, heavy=HEAVY_MODULES)
+        out = subprocess.check_output([sys.executable, '-c', probe])
+        result = json.loads(out.decode('utf-8'))
+        if best is None or result['ms'] < best['ms']:
+            best = result
+    return best
+
+
+def main(repeat=3):
+    for module in MODULES:
+        result = measure(module, repeat)
+        if result['error']:
+            print('%-20s not importable here: %s' % (module, result['error']))
+        else:
+            print('%-20s %7.1fms  %s' % (module, result['ms'], ', '.join(result['heavy']) or '-'))
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
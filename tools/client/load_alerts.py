@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+
+# Copyright 2015 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#    http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Load tests the /alert incident webhook.
+
+Every incident is opened, opened again like a Stackdriver retry, then closed,
+from a pool of threads like load_pool.
+"""
+
+import sys
+import threading
+import time
+import uuid
+
+import requests
+
+from post_alert import make_incident, post_alert
+
+
+def post_incidents(addr, nb_incidents, latencies, errors):
+    session = requests.Session()
+    for i in range(nb_incidents):
+        incident_id = uuid.uuid4().hex
+        for state in ('open', 'open', 'closed'):
+            start = time.time()
+            r = post_alert(addr, make_incident(incident_id, state, 'www%d' % i), session=session, verbose=False)
+            latencies.append(time.time() - start)
+            if r.status_code != 200:
+                errors.append(r.status_code)
+
+
+def load_alerts(addr, nb_incidents=5000, nb_threads=8):
+    latencies, errors = [], []
+    per_thread = nb_incidents // nb_threads
+    threads = [threading.Thread(target=post_incidents, args=(addr, per_thread, latencies, errors))
+               for _ in range(nb_threads)]
+    start = time.time()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.time() - start
+
+    latencies.sort()
+    print('%d incidents, %d requests in %.1fs: %d incidents per minute, %d errors.' % (
+        per_thread * nb_threads, len(latencies), elapsed, per_thread * nb_threads * 60 / elapsed, len(errors)))
+    print('Latency p50 %.1fms, p99 %.1fms, max %.1fms.' % (
+        latencies[len(latencies) // 2] * 1000, latencies[len(latencies) * 99 // 100] * 1000, latencies[-1] * 1000))
+
+
+if __name__ == '__main__':
+    load_alerts(sys.argv[1] if len(sys.argv) > 1 else 'http://localhost:3141/alert', *map(int, sys.argv[2:]))
@@ -17,23 +17,29 @@ import time
 import requests
 
 
-def post_alert(addr):
-    print('Posting an alert ...')
-
-    incident = {'incident': {'started_at': int(time.time()),
-                             'incident_id': 'f2e08c333dc64cb09f75eaab355393bz',
-                             'resource_id': 'i-4a266a2d',
-                             'state': 'open',
-                             'condition_name': 'CPU usage',
-                             'ended_at': None,
-                             'url': 'https://app.stackdriver.com/incidents/f2e08c333dc64cb09f75eaab355393bz',
-                             'resource_name': 'www1',
-                             'policy_name': 'Webserver Health',
-                             'summary': 'CPU (agent) for www1 is above the threshold of 90% with a value of 99%'
-                             },
-                'version': 1}
-    r = requests.post(addr, json=incident)
-    print('Done: Replied %s' % r.content)
+def make_incident(incident_id='f2e08c333dc64cb09f75eaab355393bz', state='open', resource_name='www1'):
+    return {'incident': {'started_at': int(time.time()),
+                         'incident_id': incident_id,
+                         'resource_id': 'i-4a266a2d',
+                         'state': state,
+                         'condition_name': 'CPU usage',
+                         'ended_at': int(time.time()) if state == 'closed' else None,
+                         'url': 'https://app.stackdriver.com/incidents/%s' % incident_id,
+                         'resource_name': resource_name,
+                         'policy_name': 'Webserver Health',
+                         'summary': 'CPU (agent) for %s is above the threshold of 90%% with a value of 99%%' %
+                                    resource_name
+                         },
+            'version': 1}
+
+
+def post_alert(addr, incident=None, session=None, verbose=True):
+    if verbose:
+        print('Posting an alert ...')
+    r = (session or requests).post(addr, json=incident or make_incident())
+    if verbose:
+        print('Done: Replied %s' % r.content)
+    return r
 
 
 if __name__ == '__main__':